@@ -1,7 +1,68 @@
+import json
+import os
+from functools import lru_cache
 import jwt
+import redis
+from redis_helper import redis_helper
+
+# Decoding is cheap, but dashboards send the same token with every request.
+@lru_cache(maxsize=1024)
+def decode_user_id(encoded_token):
+    # Verification is performed by kong (reverse proxy), 
+    # therefore token is not verified for a second time so that the secret is only stored there.
+    result = jwt.decode(encoded_token, verify=False)
+    return result["email"]
+
+# Resolved ACLs per user, shared by all workers through Redis.
+#
+# The ACL depends on user_account, organisation, view_data_access and zones, entries expire after
+# `ttl` seconds so changes made elsewhere are picked up, invalidate() removes them right away.
+class ACLCache():
+    def __init__(self, ttl=60, prefix="acl_cache"):
+        self.ttl = ttl
+        self.prefix = prefix
+
+    def get_key(self, user_id):
+        return "%s:%s" % (self.prefix, user_id)
+
+    def get(self, user_id):
+        try:
+            with redis_helper.get_resource() as r:
+                data = r.get(self.get_key(user_id))
+        except redis.exceptions.RedisError as e:
+            print("ACL cache unavailable: %s" % e)
+            return None
+        if data is None:
+            return None
+        return ACL.from_dict(json.loads(data))
+
+    def store(self, user_id, acl_user):
+        try:
+            with redis_helper.get_resource() as r:
+                r.set(self.get_key(user_id), json.dumps(acl_user.to_dict()), ex=self.ttl)
+        except redis.exceptions.RedisError as e:
+            print("ACL cache unavailable: %s" % e)
+
+    # Removes the cached ACL of one user, or of all users when user_id is None.
+    def invalidate(self, user_id=None):
+        try:
+            with redis_helper.get_resource() as r:
+                if user_id is not None:
+                    r.delete(self.get_key(user_id))
+                    return
+                keys = list(r.scan_iter(match="%s:*" % self.prefix, count=1000))
+                if keys:
+                    r.delete(*keys)
+        except redis.exceptions.RedisError as e:
+            print("ACL cache invalidation failed: %s" % e)
+
+
+acl_cache = ACLCache(ttl=int(os.getenv("ACL_CACHE_TTL", 60)))
 
 class AccessControl():
-    def retrieve_acl_user(self, request, conn):
+    # get_conn returns a database connection, it is only called on a cache miss. The ACL is cached,
+    # so it's resolved on the primary: a lagging replica would cache an ACL without a zone that was just created.
+    def retrieve_acl_user(self, request, get_conn):
         user_id = None
         consumer_username = request.headers.get("X-Consumer-Username")
         if request.headers.get('Authorization'):
@@ -11,15 +72,19 @@ class AccessControl():
         if not user_id:
             return None
 
+        acl_user = acl_cache.get(user_id)
+        if acl_user:
+            return acl_user
+
         # Get ACL and return result
-        return self.query_acl(conn, user_id)
+        acl_user = self.query_acl(get_conn(), user_id)
+        if acl_user:
+            acl_cache.store(user_id, acl_user)
+        return acl_user
     
     def get_user_id_jwt(self, encoded_token):
         encoded_token = encoded_token.split(" ")[1]
-        # Verification is performed by kong (reverse proxy), 
-        # therefore token is not verified for a second time so that the secret is only stored there.
-        result = jwt.decode(encoded_token, verify=False)
-        return result["email"]
+        return decode_user_id(encoded_token)
 
     def query_acl(self, conn, email):
         stmt = """
@@ -164,6 +229,28 @@ class ACL():
         for item in results:
             self.operator_filters.add(item[0])
 
+    # Complete state of the ACL, used to store it in the ACL cache.
+    def to_dict(self):
+        data = {}
+        data["username"] = self.username
+        data["organisation_id"] = self.organisation_id
+        data["organisation_type"] = self.organisation_type
+        data["privileges"] = self.privileges
+        data["operator_filters"] = sorted(self.operator_filters)
+        data["municipality_filters"] = sorted(self.municipality_filters)
+        data["hr_municipality_filters"] = self.hr_municipality_filters
+        data["zone_filters"] = sorted(self.zone_filters)
+        return data
+
+    @staticmethod
+    def from_dict(data):
+        acl_user = ACL(data["username"], data["organisation_id"], data["organisation_type"], data["privileges"])
+        acl_user.operator_filters = set(data["operator_filters"])
+        acl_user.municipality_filters = set(data["municipality_filters"])
+        acl_user.hr_municipality_filters = data["hr_municipality_filters"]
+        acl_user.zone_filters = set(data["zone_filters"])
+        return acl_user
+
     def serialize(self):
         data = {}
         data["username"] = self.username
@@ -0,0 +1,17 @@
+import os
+
+# Asynchronous serving mode.
+#
+# When ASYNC_MODE=gevent the app is served by uWSGI's gevent loop (see uwsgi_async.ini).
+# psycopg2 is switched to its non-blocking mode with gevent as wait callback, so a worker
+# keeps serving other requests while a query waits for PostgreSQL instead of blocking the process.
+def is_enabled():
+    return os.getenv("ASYNC_MODE") == "gevent"
+
+def enable():
+    if not is_enabled():
+        return False
+    from psycogreen.gevent import patch_psycopg
+    patch_psycopg()
+    print("Async mode enabled, psycopg2 uses gevent")
+    return True
@@ -1,6 +1,9 @@
 import datetime
 import json
 
+class InvalidFilter(Exception):
+    pass
+
 # This class is a factory for generic filters.
 class DataFilter():
     def __init__(self):
@@ -14,10 +17,15 @@ class DataFilter():
         self.latlng = []
         self.form_factors = []
         self.geojson = {}
+        # Map viewport as [sw_lng, sw_lat, ne_lng, ne_lat].
+        self.bbox = None
 
     def add_zones(self, args):
         if args.get("zone_ids"):
-            self.zones = args.get("zone_ids").split(",")
+            self.zones = [zone_id.strip() for zone_id in args.get("zone_ids").split(",")]
+            for zone_id in self.zones:
+                if not zone_id.isdigit():
+                    raise InvalidFilter("Invalid zone_id '%s', zone_ids should be a comma separated list of integers" % zone_id)
 
     def add_zone(self, zone_id):
         self.zones.append(zone_id)
@@ -27,6 +35,10 @@ class DataFilter():
             return (-1,)
         return tuple(self.zones)
 
+    # Zone ids as integers, used with = ANY(%s) in prepared statements.
+    def get_zone_ids(self):
+        return [int(zone_id) for zone_id in self.get_zones()]
+
     def has_zone_filter(self):
         return len(self.zones) > 0
 
@@ -127,6 +139,26 @@ class DataFilter():
     def has_geojson(self):
         return self.geojson;
 
+    # bbox=sw_lng,sw_lat,ne_lng,ne_lat, an invalid bbox is left unset.
+    def add_bbox(self, args):
+        if not args.get("bbox"):
+            return
+        try:
+            bbox = [float(value) for value in args.get("bbox").split(",")]
+        except ValueError:
+            return
+        if len(bbox) != 4 or bbox[0] >= bbox[2] or bbox[1] >= bbox[3]:
+            return
+        if bbox[0] < -180 or bbox[2] > 180 or bbox[1] < -90 or bbox[3] > 90:
+            return
+        self.bbox = bbox
+
+    def get_bbox(self):
+        return self.bbox
+
+    def has_bbox(self):
+        return self.bbox is not None
+
     def add_filters_based_on_acl(self, acl):
         if acl.organisation_type == "ADMIN":
             return
@@ -135,6 +167,23 @@ class DataFilter():
         for zone_id in acl.zone_filters:
             self.add_zone(zone_id)
 
+    # The filter in canonical form, filters that select the same data give the same dict
+    # regardless of the order of zones, operators and form factors in the request.
+    def to_canonical_dict(self):
+        data = {}
+        data["zones"] = sorted(set(self.zones))
+        data["operators"] = sorted(set(self.operators))
+        data["form_factors"] = sorted(set(self.form_factors))
+        data["municipalities"] = sorted(set(self.municipalities))
+        data["gm_code"] = self.gm_code
+        data["timestamp"] = self.timestamp.isoformat() if self.timestamp else None
+        data["start_time"] = self.start_time
+        data["end_time"] = self.end_time
+        data["latlng"] = self.latlng
+        data["geojson"] = self.geojson
+        data["bbox"] = self.bbox
+        return data
+
     def to_json(self):
         return json.dumps(self, default=lambda o: o.__dict__, 
             sort_keys=True, indent=4)
@@ -151,6 +200,7 @@ class DataFilter():
         filter.add_form_factor(args)
         filter.add_municipalities(args)
         filter.add_geojson(args)
+        filter.add_bbox(args)
 
         return filter
 
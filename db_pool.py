@@ -0,0 +1,195 @@
+import threading
+import time
+import psycopg2
+import psycopg2.extensions
+
+class PoolTimeout(Exception):
+    def __init__(self, pool_name, timeout):
+        Exception.__init__(self, "No connection available in pool '%s' within %ss" % (pool_name, timeout))
+        self.pool_name = pool_name
+        self.timeout = timeout
+
+# Cursor of a PooledConnection. While a query budget is attached to the connection (see
+# query_budget.QueryBudget.apply) every statement is sent as "SET LOCAL statement_timeout = <left>; <statement>",
+# so each statement is limited to what is left of the budget without an extra round trip.
+# Named cursors are declared by psycopg2 itself, their timeout is set with a separate statement.
+class PooledCursor(psycopg2.extensions.cursor):
+    def execute(self, query, vars=None):
+        budget = self.connection.query_budget
+        if budget is None or not isinstance(query, str):
+            return super().execute(query, vars)
+        if self.name is not None:
+            psycopg2.extensions.cursor(self.connection).execute(budget.timeout_statement())
+            return super().execute(query, vars)
+        return super().execute(budget.timeout_statement() + "; " + query, vars)
+
+# Connections handed out by the pool are of this class, so bookkeeping
+# (age, checkout time, prepared statements, query budget) can live on the connection itself.
+class PooledConnection(psycopg2.extensions.connection):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.cursor_factory = PooledCursor
+        self.created_at = time.monotonic()
+        self.returned_at = self.created_at
+        self.checked_out_at = None
+        self.prepared_statements = set()
+        self.query_budget = None
+
+# Thread-safe connection pool that replaces psycopg2's SimpleConnectionPool.
+#
+# getconn() blocks up to `timeout` seconds when all connections are in use instead of raising
+# immediately, connections older than `max_age` are recycled and connections that were idle
+# for longer than `validate_after` seconds are pinged before they are handed out, so stale
+# connections after a database failover are replaced instead of failing a request.
+# The primitives from threading are used, so the pool is also safe when uWSGI runs with
+# threads or with gevent monkey patching.
+class ConnectionPool():
+    def __init__(self, name, dsn, maxconn=10, timeout=10, max_age=3600, validate_after=30):
+        self.name = name
+        self.dsn = dsn
+        self.maxconn = maxconn
+        self.timeout = timeout
+        self.max_age = max_age
+        self.validate_after = validate_after
+
+        self._condition = threading.Condition()
+        self._idle = []
+        self._size = 0
+
+        self._checkouts = 0
+        self._waits = 0
+        self._total_wait_time = 0.0
+        self._max_wait_time = 0.0
+        self._total_checkout_time = 0.0
+        self._max_checkout_time = 0.0
+        self._exhausted = 0
+        self._created = 0
+        self._discarded = 0
+
+    def getconn(self, timeout=None):
+        if timeout is None:
+            timeout = self.timeout
+        started_waiting = time.monotonic()
+        deadline = started_waiting + timeout
+        waited = False
+
+        while True:
+            conn = None
+            with self._condition:
+                while not self._idle and self._size >= self.maxconn:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        # A timeout of 0 is a non-blocking attempt, that doesn't count as exhaustion.
+                        if timeout > 0:
+                            self._exhausted += 1
+                            print("Connection pool '%s' exhausted, %s connections in use" % (self.name, self._size))
+                        raise PoolTimeout(self.name, timeout)
+                    waited = True
+                    self._condition.wait(remaining)
+
+                if self._idle:
+                    conn = self._idle.pop()
+                else:
+                    self._size += 1
+
+            if conn is None:
+                conn = self._connect()
+            elif not self._is_usable(conn):
+                self._discard(conn)
+                continue
+
+            wait_time = time.monotonic() - started_waiting
+            with self._condition:
+                self._checkouts += 1
+                if waited:
+                    self._waits += 1
+                self._total_wait_time += wait_time
+                self._max_wait_time = max(self._max_wait_time, wait_time)
+            conn.checked_out_at = time.monotonic()
+            return conn
+
+    def putconn(self, conn, close=False):
+        if conn.checked_out_at is not None:
+            checkout_time = time.monotonic() - conn.checked_out_at
+            conn.checked_out_at = None
+            with self._condition:
+                self._total_checkout_time += checkout_time
+                self._max_checkout_time = max(self._max_checkout_time, checkout_time)
+
+        if close or conn.closed:
+            self._discard(conn)
+            return
+
+        try:
+            status = conn.info.transaction_status
+            if status == psycopg2.extensions.TRANSACTION_STATUS_UNKNOWN:
+                self._discard(conn)
+                return
+            if status != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+                conn.rollback()
+        except psycopg2.Error:
+            self._discard(conn)
+            return
+
+        conn.returned_at = time.monotonic()
+        with self._condition:
+            self._idle.append(conn)
+            self._condition.notify()
+
+    def _connect(self):
+        try:
+            conn = psycopg2.connect(self.dsn, connection_factory=PooledConnection)
+        except Exception:
+            with self._condition:
+                self._size -= 1
+                self._condition.notify()
+            raise
+        with self._condition:
+            self._created += 1
+        return conn
+
+    def _discard(self, conn):
+        try:
+            conn.close()
+        except Exception:
+            pass
+        with self._condition:
+            self._size -= 1
+            self._discarded += 1
+            self._condition.notify()
+
+    def _is_usable(self, conn):
+        if conn.closed:
+            return False
+        now = time.monotonic()
+        if now - conn.created_at > self.max_age:
+            return False
+        if now - conn.returned_at < self.validate_after:
+            return True
+        try:
+            cur = conn.cursor()
+            cur.execute("SELECT 1")
+            cur.close()
+            conn.rollback()
+        except psycopg2.Error:
+            return False
+        return True
+
+    def stats(self):
+        with self._condition:
+            return {
+                "name": self.name,
+                "size": self._size,
+                "idle": len(self._idle),
+                "in_use": self._size - len(self._idle),
+                "maxconn": self.maxconn,
+                "created": self._created,
+                "discarded": self._discarded,
+                "checkouts": self._checkouts,
+                "waits": self._waits,
+                "exhausted": self._exhausted,
+                "total_wait_time": round(self._total_wait_time, 3),
+                "max_wait_time": round(self._max_wait_time, 3),
+                "total_checkout_time": round(self._total_checkout_time, 3),
+                "max_checkout_time": round(self._max_checkout_time, 3)
+            }
@@ -0,0 +1,102 @@
+import itertools
+import threading
+import time
+import psycopg2
+import db_pool
+
+# Routes read-only work to replica pools and falls back to the primary pool
+# when no replica is available or all replicas lag too far behind.
+class ReplicaRouter():
+    def __init__(self, primary_pool, replica_pools, max_lag=30, check_interval=5):
+        self.primary_pool = primary_pool
+        self.replica_pools = replica_pools
+        self.max_lag = max_lag
+        self.check_interval = check_interval
+        self._round_robin = itertools.cycle(range(len(replica_pools))) if replica_pools else None
+        self._lock = threading.Lock()
+        # Per replica: (time of last check, lag in seconds or None when the replica was unreachable).
+        self._status = {}
+        self._fallbacks = 0
+
+    def has_replicas(self):
+        return len(self.replica_pools) > 0
+
+    # Returns (pool, conn), the connection should be returned to that pool.
+    def getconn(self, timeout=None):
+        for pool in self._replica_order():
+            if not self._is_healthy(pool):
+                continue
+            try:
+                conn = pool.getconn(timeout=0)
+            except db_pool.PoolTimeout:
+                continue
+            except psycopg2.Error as e:
+                print("Replica '%s' unreachable: %s" % (pool.name, e))
+                self._set_status(pool, None)
+                continue
+            if self._check_lag(pool, conn):
+                return pool, conn
+            pool.putconn(conn)
+
+        with self._lock:
+            self._fallbacks += 1
+        return self.primary_pool, self.primary_pool.getconn(timeout)
+
+    def _replica_order(self):
+        if not self.replica_pools:
+            return []
+        with self._lock:
+            start = next(self._round_robin)
+        return self.replica_pools[start:] + self.replica_pools[:start]
+
+    # _status is written by the lag checks of concurrent requests, it's only accessed under the lock.
+    def _get_status(self, pool, default):
+        with self._lock:
+            return self._status.get(pool.name, default)
+
+    def _set_status(self, pool, lag):
+        with self._lock:
+            self._status[pool.name] = (time.monotonic(), lag)
+
+    def _is_healthy(self, pool):
+        checked_at, lag = self._get_status(pool, (None, 0))
+        if checked_at is None or time.monotonic() - checked_at > self.check_interval:
+            return True
+        return lag is not None and lag <= self.max_lag
+
+    def _check_lag(self, pool, conn):
+        checked_at, lag = self._get_status(pool, (None, 0))
+        if checked_at is not None and time.monotonic() - checked_at <= self.check_interval:
+            return lag is not None and lag <= self.max_lag
+
+        stmt = """
+            SELECT CASE
+                WHEN pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0
+                ELSE COALESCE(EXTRACT(EPOCH FROM NOW() - pg_last_xact_replay_timestamp()), 0)
+            END
+        """
+        try:
+            cur = conn.cursor()
+            cur.execute(stmt)
+            lag = float(cur.fetchone()[0])
+            conn.commit()
+        except psycopg2.Error as e:
+            print("Replica '%s' lag check failed: %s" % (pool.name, e))
+            lag = None
+        self._set_status(pool, lag)
+        if lag is None or lag > self.max_lag:
+            print("Replica '%s' not used, lag is %s seconds" % (pool.name, lag))
+            return False
+        return True
+
+    def stats(self):
+        result = {}
+        with self._lock:
+            result["fallbacks_to_primary"] = self._fallbacks
+        result["replicas"] = []
+        for pool in self.replica_pools:
+            checked_at, lag = self._get_status(pool, (None, None))
+            replica = pool.stats()
+            replica["lag"] = lag
+            result["replicas"].append(replica)
+        return result
@@ -0,0 +1,4 @@
+-- Indexes for keyset pagination of the list endpoints, see pagination.py.
+CREATE INDEX IF NOT EXISTS trips_start_time_trip_id_idx ON trips (start_time, trip_id);
+CREATE INDEX IF NOT EXISTS park_events_start_time_park_event_id_idx ON park_events (start_time, park_event_id);
+CREATE INDEX IF NOT EXISTS park_events_end_time_park_event_id_idx ON park_events (end_time, park_event_id);
@@ -1,12 +1,15 @@
+import async_mode
+async_mode.enable()
+
 from decimal import Decimal
 from flask import Flask, jsonify, request, g, abort, send_file, after_this_request, send_from_directory
 from functools import wraps
 
 from flask.json import JSONEncoder
-from psycopg2.pool import SimpleConnectionPool
 from datetime import date
 import datetime
 import psycopg2
+import psycopg2.errors
 import os
 import json
 import io
@@ -20,6 +23,7 @@ import park_events
 import data_filter
 import access_control
 import rentals
+import vehicles
 import report.generate_xlsx
 import export_raw_data.create_export_task
 import audit_log
@@ -29,6 +33,19 @@ import stats_aggregated_rentals
 import stats_v2.availability_stats as availability_stats
 import stats_v2.rental_stats as rental_stats
 from redis_helper import redis_helper
+from prepared_statements import statement_registry
+import db_pool
+import db_router
+from query_budget import budget_monitor
+from query_executor import query_executor
+import streaming
+import pagination
+import projection
+import spatial_bins
+import sync
+from municipality_index import municipality_index
+import zone_geometries
+from response_cache import response_cache, static_ttl, until_next_feed_import, until_next_feed_import_or_historic
 
 # Initialisation
 conn_str = f"dbname={os.getenv('DB_NAME')}"
@@ -42,11 +59,44 @@ if "DB_PASSWORD" in os.environ:
 if "DB_PORT" in os.environ:
     conn_str += " port={}".format(os.environ['DB_PORT'])
 
+municipality_lookup_max_locations = int(os.getenv('MUNICIPALITY_LOOKUP_MAX_LOCATIONS', 1000))
+parkeertelling_max_features = int(os.getenv('PARKEERTELLING_MAX_FEATURES', 1000))
+parkeertelling_max_timestamps = int(os.getenv('PARKEERTELLING_MAX_TIMESTAMPS', 48))
+
+db_pool_maxconn = int(os.getenv('DB_POOL_MAXCONN', 10))
+db_pool_timeout = float(os.getenv('DB_POOL_TIMEOUT', 10))
+db_pool_max_age = float(os.getenv('DB_POOL_MAX_AGE', 3600))
+
 # conn = psycopg2.connect(conn_str)
 print(conn_str)
-pgpool = SimpleConnectionPool(minconn=1, 
-        maxconn=10, 
-        dsn=conn_str)
+pgpool = db_pool.ConnectionPool("postgresql",
+        dsn=conn_str,
+        maxconn=db_pool_maxconn,
+        timeout=db_pool_timeout,
+        max_age=db_pool_max_age)
+
+replica_pools = []
+# DB_REPLICA_HOSTS is a comma separated list of host[:port], empty entries are skipped.
+for replica_host in os.getenv('DB_REPLICA_HOSTS', '').split(","):
+    if not replica_host.strip():
+        continue
+    replica_host, _, replica_port = replica_host.strip().partition(":")
+    conn_str_replica = f"dbname={os.getenv('DB_NAME')} host={replica_host}"
+    if "DB_USER" in os.environ:
+        conn_str_replica += " user={}".format(os.environ['DB_USER'])
+    if "DB_PASSWORD" in os.environ:
+        conn_str_replica += " password={}".format(os.environ['DB_PASSWORD'])
+    replica_port = replica_port or os.getenv('DB_PORT', '5432')
+    conn_str_replica += " port={}".format(replica_port)
+    # The pool name keys the lag and health status of the replica, so it includes the port.
+    replica_pools.append(db_pool.ConnectionPool("replica-{}:{}".format(replica_host, replica_port),
+        dsn=conn_str_replica,
+        maxconn=db_pool_maxconn,
+        timeout=db_pool_timeout,
+        max_age=db_pool_max_age))
+
+replicaRouter = db_router.ReplicaRouter(pgpool, replica_pools,
+    max_lag=float(os.getenv('DB_REPLICA_MAX_LAG', 30)))
 
 conn_str_timescale_db = f"dbname={os.getenv('TIMESCALEDB_NAME')}"
 if os.getenv('DEV') == 'true':
@@ -61,9 +111,11 @@ if "TIMESCALE_DB_PASSWORD" in os.environ:
 if "TIMESCALE_DB_PORT" in os.environ:
     conn_str_timescale_db += " port={}".format(os.environ['TIMESCALE_DB_PORT'])
 
-timescaledb_pgpool = SimpleConnectionPool(minconn=1, 
-        maxconn=10, 
-        dsn=conn_str_timescale_db)
+timescaledb_pgpool = db_pool.ConnectionPool("timescaledb",
+        dsn=conn_str_timescale_db,
+        maxconn=db_pool_maxconn,
+        timeout=db_pool_timeout,
+        max_age=db_pool_max_age)
 
 tripAdapter = trips.Trips()
 tripAdapterV2 = trips_v2.Trips()
@@ -74,6 +126,7 @@ accessControl = access_control.AccessControl()
 statsAggregatedAvailability = stats_aggregated_availability.AggregatedStatsAvailability()
 statsAggregatedRentals = stats_aggregated_rentals.AggregatedStatsRentals()
 parkEventsAdapter = park_events.ParkEvents()
+vehicleAdapter = vehicles.Vehicles()
 availabilityStatsAdapter = availability_stats.AvailabilityStats()
 rentalStatsAdapter = rental_stats.RentalStats()
 
@@ -110,7 +163,7 @@ class InvalidUsage(Exception):
 def requires_auth(f):
     @wraps(f)
     def decorated(*args, **kwargs):
-        g.acl = accessControl.retrieve_acl_user(request, get_conn())
+        g.acl = accessControl.retrieve_acl_user(request, get_conn)
         if not g.acl:  
             abort(401)
         return f(*args, **kwargs)
@@ -124,26 +177,97 @@ def not_authorized(error_msg):
 app = Flask(__name__)
 app.json_encoder = CustomJSONEncoder
 
+@app.before_request
+def start_query_budget():
+    g.query_budget = budget_monitor.start(request.endpoint)
+
+def checkout_timeout(pool):
+    return min(pool.timeout, g.query_budget.remaining_seconds())
+
 def get_conn():
     if 'db' not in g:
-        g.db = pgpool.getconn()
+        g.db = pgpool.getconn(checkout_timeout(pgpool))
+        g.query_budget.apply(g.db)
     return g.db
 
+# Connection for read-only work, served by a replica when one is configured and not lagging.
+def get_read_conn():
+    if not replicaRouter.has_replicas() or g.get('read_from_primary'):
+        return get_conn()
+    if 'db_read' not in g:
+        g.db_read_pool, g.db_read = replicaRouter.getconn(checkout_timeout(pgpool))
+        g.query_budget.apply(g.db_read)
+    return g.db_read
+
+# Every route that returns data filtered on zone_ids calls this after the authorization check and
+# before it takes its read connection: zone ids that don't exist are a 400 instead of an empty result.
+# Existing ids are cached (zone_geometries.known_zone_ids), so the check usually costs no query.
+# A zone that was just created may not be on the replicas yet, when the primary has it the request
+# reads from the primary.
+def check_zone_ids(d_filter):
+    if not d_filter.has_zone_filter():
+        return
+    unknown_zone_ids = zone_geometries.known_zone_ids.find_unknown(get_read_conn, d_filter.get_zone_ids())
+    if unknown_zone_ids and replicaRouter.has_replicas() and not g.get('read_from_primary'):
+        unknown_zone_ids = zone_geometries.known_zone_ids.find_unknown(get_conn, unknown_zone_ids)
+        if not unknown_zone_ids:
+            g.read_from_primary = True
+    if unknown_zone_ids:
+        raise InvalidUsage("Unknown zone_ids: %s" % ", ".join(str(zone_id) for zone_id in unknown_zone_ids), status_code=400)
+
+# Extra read connection for the query executor, only taken when one is available right away.
+def checkout_extra_read_conn():
+    try:
+        if replicaRouter.has_replicas() and not g.get('read_from_primary'):
+            pool, conn = replicaRouter.getconn(0)
+        else:
+            pool, conn = pgpool, pgpool.getconn(0)
+    except db_pool.PoolTimeout:
+        return None
+    g.query_budget.apply(conn)
+    return pool, conn
+
+def release_extra_conn(handle):
+    pool, conn = handle
+    g.query_budget.release(conn)
+    pool.putconn(conn)
+
+# Runs independent adapter calls concurrently, see query_executor.QueryExecutor.
+def run_queries(conn, calls):
+    return query_executor.run(conn, calls, checkout_extra_read_conn, release_extra_conn)
+
 def get_timescaledb_conn():
     if 'timescaledb' not in g:
-        g.timescaledb = timescaledb_pgpool.getconn()
+        g.timescaledb = timescaledb_pgpool.getconn(checkout_timeout(timescaledb_pgpool))
+        g.query_budget.apply(g.timescaledb)
     return g.timescaledb
 
 @app.teardown_appcontext
 def close_db(e=None):
+    query_budget = g.pop('query_budget', None)
+    if query_budget is not None:
+        budget_monitor.finish(query_budget)
+
     db = g.pop('db', None)
 
     if db is not None:
+        if query_budget is not None:
+            query_budget.release(db)
         pgpool.putconn(db)
 
+    db_read = g.pop('db_read', None)
+    db_read_pool = g.pop('db_read_pool', None)
+
+    if db_read is not None:
+        if query_budget is not None:
+            query_budget.release(db_read)
+        db_read_pool.putconn(db_read)
+
     timescaledb = g.pop('timescaledb', None)
 
     if timescaledb is not None:
+        if query_budget is not None:
+            query_budget.release(timescaledb)
         timescaledb_pgpool.putconn(timescaledb)
     
 
@@ -153,6 +277,33 @@ def handle_invalid_usage(error):
     response.status_code = error.status_code
     return response
 
+@app.errorhandler(data_filter.InvalidFilter)
+def handle_invalid_filter(error):
+    return handle_invalid_usage(InvalidUsage(str(error), status_code=400))
+
+@app.errorhandler(db_pool.PoolTimeout)
+def handle_pool_timeout(error):
+    data = g.query_budget.serialize()
+    data["code"] = 503
+    data["message"] = "Server is too busy, no database connection available."
+    data["pool"] = error.pool_name
+    response = jsonify(data)
+    response.status_code = 503
+    return response
+
+@app.errorhandler(psycopg2.errors.QueryCanceled)
+def handle_query_canceled(error):
+    data = g.query_budget.serialize()
+    if g.query_budget.cancel_reason == "client_disconnected":
+        data["code"] = 503
+        data["message"] = "Query cancelled, the client disconnected."
+    else:
+        data["code"] = 504
+        data["message"] = "Query time budget exceeded."
+    response = jsonify(data)
+    response.status_code = data["code"]
+    return response
+
 @app.errorhandler(401)
 def unauthorized(error):
     print(error)
@@ -160,24 +311,8 @@ def unauthorized(error):
     response.status_code = 401
     return response
 
-def get_bicycles_within_bounding_box(sw_lng, sw_lat, ne_lng, ne_lat):
-    conn = get_conn()
-    cur = conn.cursor()
-    stmt = """
-        SELECT last_time_imported, last_detection_bike.bike_id,
-            ST_Y(location), ST_X(location), last_detection_bike.system_id,
-            is_check_in, is_check_out 
-	    FROM last_detection_bike 
-        WHERE location && ST_MakeEnvelope(%s, %s, %s, %s, 4326)
-    """
-    try:
-        cur.execute(stmt, (sw_lng, sw_lat, ne_lng, ne_lat))
-    except:
-        conn.rollback()
-    return cur.fetchall()
-
 def get_bicycles_in_municipality(municipality):
-    conn = get_conn()
+    conn = get_read_conn()
     cur = conn.cursor()
     stmt = """SELECT last_time_imported, q1.bike_id,
         ST_Y(location), ST_X(location), q1.system_id, 
@@ -198,7 +333,7 @@ def get_bicycles_in_municipality(municipality):
     return cur.fetchall()
 
 def get_all_bicycles():
-    conn = get_conn()
+    conn = get_read_conn()
     cur = conn.cursor()
     stmt = """SELECT last_time_imported, last_detection_cycle.bike_id,
             ST_Y(location), ST_X(location), last_detection_cycle.system_id, 
@@ -207,9 +342,21 @@ def get_all_bicycles():
     cur.execute(stmt)
     return cur.fetchall()
 
+# Shows the replica hosts and the prepared statements, so it's only for admins.
+@app.route("/status/db_pools")
+@requires_auth
+def get_db_pool_stats():
+    if g.acl.organisation_type != "ADMIN":
+        return not_authorized("Only admins can view the database pool stats.")
+    result = {}
+    result["pools"] = [pgpool.stats(), timescaledb_pgpool.stats()]
+    result["replica_routing"] = replicaRouter.stats()
+    result["prepared_statements"] = statement_registry.stats()
+    return jsonify(result)
+
 @app.route("/area")
 def get_areas():
-    conn = get_conn()
+    conn = get_read_conn()
     output = {}
     if request.args.get('gm_code'):
         area = get_municipality_area(conn, request.args.get('gm_code'))[0]
@@ -232,25 +379,42 @@ def get_municipality_area(conn, municipality):
 @app.route("/trips")
 @requires_auth
 def get_trips():
-    conn = get_conn()
     d_filter = data_filter.DataFilter.build(request.args)
     authorized, error = g.acl.is_authorized(d_filter)
     if not authorized:
         return not_authorized(error)
+    check_zone_ids(d_filter)
+    conn = get_read_conn()
 
+    if is_count_only():
+        result = {}
+        result["trips_count"] = tripAdapter.count_trips(conn, d_filter)
+        conn.commit()
+        return jsonify(result)
+
+    field_projection = get_projection(tripAdapter.fields)
+    if streaming.is_requested(request.args):
+        cur = conn.cursor(name="trips")
+        tripAdapter.query_trips(cur, d_filter, projection=field_projection)
+        return streaming.stream_json([("trips", cur, serializer(field_projection, tripAdapter.serialize_trip))])
+
+    page = get_pagination(d_filter)
     result = {}
-    result["trips"] = tripAdapter.get_trips(conn, d_filter)
+    result["trips"] = tripAdapter.get_trips(conn, d_filter, page, field_projection)
+    if page:
+        result["pagination"] = page.serialize()
     conn.commit()
     return jsonify(result)
 
 @app.route("/trips/stats")
 @requires_auth
 def get_trips_stats():
-    conn = get_conn()
     d_filter = data_filter.DataFilter.build(request.args)
     authorized, error = g.acl.is_authorized(d_filter)
     if not authorized:
         return not_authorized(error)
+    check_zone_ids(d_filter)
+    conn = get_read_conn()
 
     if not d_filter.get_start_time():
         raise InvalidUsage("No start_time specified", status_code=400)
@@ -266,14 +430,30 @@ def get_trips_stats():
 @app.route("/v2/trips/origins")
 @requires_auth
 def get_trips_origins():
-    conn = get_conn()
     d_filter = data_filter.DataFilter.build(request.args)
     authorized, error = g.acl.is_authorized(d_filter)
     if not authorized:
         return not_authorized(error)
+    check_zone_ids(d_filter)
+    conn = get_read_conn()
 
+    if is_count_only():
+        result = {}
+        result["trip_origins_count"] = tripAdapterV2.count_trip_origins(conn, d_filter)
+        conn.commit()
+        return jsonify(result)
+
+    field_projection = get_projection(tripAdapterV2.origin_fields)
+    if streaming.is_requested(request.args):
+        cur = conn.cursor(name="trip_origins")
+        tripAdapterV2.query_trip_origins(cur, d_filter, projection=field_projection)
+        return streaming.stream_json([("trip_origins", cur, serializer(field_projection, tripAdapterV2.serialize_trip_event))])
+
+    page = get_pagination(d_filter)
     result = {}
-    result["trip_origins"] = tripAdapterV2.get_trip_origins(conn, d_filter)
+    result["trip_origins"] = tripAdapterV2.get_trip_origins(conn, d_filter, page, field_projection)
+    if page:
+        result["pagination"] = page.serialize()
     conn.commit()
     return jsonify(result)
 
@@ -281,43 +461,166 @@ def get_trips_origins():
 @app.route("/v2/trips/destinations")
 @requires_auth
 def get_trips_destinations():
-    conn = get_conn()
+    d_filter = data_filter.DataFilter.build(request.args)
+    authorized, error = g.acl.is_authorized(d_filter)
+    if not authorized:
+        return not_authorized(error)
+    check_zone_ids(d_filter)
+    conn = get_read_conn()
+
+    if is_count_only():
+        result = {}
+        result["trip_destinations_count"] = tripAdapterV2.count_trip_destinations(conn, d_filter)
+        conn.commit()
+        return jsonify(result)
+
+    field_projection = get_projection(tripAdapterV2.destination_fields)
+    if streaming.is_requested(request.args):
+        cur = conn.cursor(name="trip_destinations")
+        tripAdapterV2.query_trip_destinations(cur, d_filter, projection=field_projection)
+        return streaming.stream_json([("trip_destinations", cur, serializer(field_projection, tripAdapterV2.serialize_trip_event))])
+
+    page = get_pagination(d_filter)
+    result = {}
+    result["trip_destinations"] = tripAdapterV2.get_trip_destinations(conn, d_filter, page, field_projection)
+    if page:
+        result["pagination"] = page.serialize()
+    conn.commit()
+    return jsonify(result)
 
+@app.route("/v2/trips/od_matrix")
+@requires_auth
+def get_trips_od_matrix():
     d_filter = data_filter.DataFilter.build(request.args)
     authorized, error = g.acl.is_authorized(d_filter)
     if not authorized:
         return not_authorized(error)
-    
+    check_zone_ids(d_filter)
+
+    if not d_filter.has_zone_filter():
+        raise InvalidUsage("No zone_ids specified", status_code=400)
+    if not d_filter.get_start_time():
+        raise InvalidUsage("No start_time specified", status_code=400)
+    if not d_filter.get_end_time():
+        raise InvalidUsage("No end_time specified", status_code=400)
+    conn = get_read_conn()
+
     result = {}
-    result["trip_destinations"] = tripAdapterV2.get_trip_destinations(conn, d_filter)
+    result["od_matrix"] = tripAdapterV2.get_od_matrix(conn, d_filter)
+    conn.commit()
+    return jsonify(result)
+
+@app.route("/v2/trips/histogram")
+@requires_auth
+def get_trips_histogram():
+    d_filter = data_filter.DataFilter.build(request.args)
+    authorized, error = g.acl.is_authorized(d_filter)
+    if not authorized:
+        return not_authorized(error)
+    check_zone_ids(d_filter)
+
+    if not d_filter.get_start_time():
+        raise InvalidUsage("No start_time specified", status_code=400)
+    if not d_filter.get_end_time():
+        raise InvalidUsage("No end_time specified", status_code=400)
+    conn = get_read_conn()
+
+    result = {}
+    result["trip_histogram"] = tripAdapterV2.get_histogram(conn, d_filter)
+    conn.commit()
+    return jsonify(result)
+
+# Heatmaps of trip origins and destinations, binned in square or hex bins (see spatial_bins.py).
+@app.route("/v2/trips/origins/heatmap")
+@requires_auth
+def get_trips_origins_heatmap():
+    d_filter = data_filter.DataFilter.build(request.args)
+    authorized, error = g.acl.is_authorized(d_filter)
+    if not authorized:
+        return not_authorized(error)
+    check_zone_ids(d_filter)
+    check_bbox(d_filter)
+    bins = get_heatmap_bins(d_filter)
+    conn = get_read_conn()
+
+    result = {}
+    result["trip_origins_heatmap"] = tripAdapterV2.get_trip_origins_heatmap(conn, d_filter, bins)
+    result["bins"] = bins.serialize()
+    conn.commit()
+    return jsonify(result)
+
+@app.route("/v2/trips/destinations/heatmap")
+@requires_auth
+def get_trips_destinations_heatmap():
+    d_filter = data_filter.DataFilter.build(request.args)
+    authorized, error = g.acl.is_authorized(d_filter)
+    if not authorized:
+        return not_authorized(error)
+    check_zone_ids(d_filter)
+    check_bbox(d_filter)
+    bins = get_heatmap_bins(d_filter)
+    conn = get_read_conn()
+
+    result = {}
+    result["trip_destinations_heatmap"] = tripAdapterV2.get_trip_destinations_heatmap(conn, d_filter, bins)
+    result["bins"] = bins.serialize()
     conn.commit()
     return jsonify(result)
 
 @app.route("/rentals")
 @requires_auth
 def get_rentals():
-    conn = get_conn()
-
     d_filter = data_filter.DataFilter.build(request.args)
     authorized, error = g.acl.is_authorized(d_filter)
     if not authorized:
         return not_authorized(error)
+    check_zone_ids(d_filter)
+    conn = get_read_conn()
+
+    if is_count_only():
+        result = {}
+        result["start_rentals_count"], result["end_rentals_count"] = run_queries(conn, [
+            lambda conn: rentalAdapter.count_start_trips(conn, d_filter),
+            lambda conn: rentalAdapter.count_end_trips(conn, d_filter)
+        ])
+        conn.commit()
+        return jsonify(result)
 
+    rental_fields = rentalAdapter.start_fields + rentalAdapter.end_fields
+    start_projection = get_projection(rentalAdapter.start_fields, rental_fields)
+    end_projection = get_projection(rentalAdapter.end_fields, rental_fields)
+    if streaming.is_requested(request.args):
+        start_cur = conn.cursor(name="start_rentals")
+        rentalAdapter.query_start_trips(start_cur, d_filter, projection=start_projection)
+        end_cur = conn.cursor(name="end_rentals")
+        rentalAdapter.query_end_trips(end_cur, d_filter, projection=end_projection)
+        return streaming.stream_json([
+            ("start_rentals", start_cur,
+                serializer(start_projection, lambda rental: rentalAdapter.serialize_rental(rental, False))),
+            ("end_rentals", end_cur,
+                serializer(end_projection, lambda rental: rentalAdapter.serialize_rental(rental, True)))
+        ])
+
+    page = get_pagination(d_filter)
     result = {}
-    result["start_rentals"] = rentalAdapter.get_start_trips(conn, d_filter)
-    result["end_rentals"] = rentalAdapter.get_end_trips(conn, d_filter)
+    result["start_rentals"], result["end_rentals"] = run_queries(conn, [
+        lambda conn: rentalAdapter.get_start_trips(conn, d_filter, page, start_projection),
+        lambda conn: rentalAdapter.get_end_trips(conn, d_filter, page, end_projection)
+    ])
+    if page:
+        result["pagination"] = page.serialize()
     conn.commit()
     return jsonify(result)
 
 @app.route("/rentals/stats")
 @requires_auth
 def get_rentals_stats():
-    conn = get_conn()
-
     d_filter = data_filter.DataFilter.build(request.args)
     authorized, error = g.acl.is_authorized(d_filter)
     if not authorized:
         return not_authorized(error)
+    check_zone_ids(d_filter)
+    conn = get_read_conn()
 
     if not d_filter.get_start_time():
         raise InvalidUsage("No start_time specified", status_code=400)
@@ -331,7 +634,7 @@ def get_rentals_stats():
 
 @app.route("/zones")
 def get_zones():
-    conn = get_conn()
+    conn = get_read_conn()
 
     d_filter = data_filter.DataFilter.build(request.args)
     if not (d_filter.has_zone_filter() or d_filter.has_municipalities()):
@@ -359,6 +662,9 @@ def zone(zone_id):
 
     deleted = zoneAdapter.delete_zone(conn, zone_id)
     conn.commit()
+    if deleted:
+        zone_geometries.known_zone_ids.forget(int(zone_id))
+    invalidate_zone_responses()
     return jsonify({"deleted": deleted})
 
 @app.route("/zone", methods=['PUT', 'POST'])
@@ -381,12 +687,22 @@ def insert_zone():
     result, err = zoneAdapter.create_zone(conn, zone_data)
     if err:
         raise InvalidUsage(err, status_code=400)
+    invalidate_zone_responses()
     return jsonify(result), 201
 
+# Cached public responses that list zones or depend on zone membership.
+def invalidate_zone_responses():
+    # The zones a user has access to are part of the cached ACL.
+    access_control.acl_cache.invalidate()
+    response_cache.invalidate("public_zones")
+    response_cache.invalidate("public_filters")
+    response_cache.invalidate("public_park_events_stats")
+
 # publicZonesAdapter = public_zoning_stats.PublicZoningStats(conn)
 @app.route("/public/zones", methods=['GET'])
+@response_cache.cached("public_zones", static_ttl(3600), args=("include_geojson",))
 def get_public_zones():
-    conn = get_conn()
+    conn = get_read_conn()
     d_filter = data_filter.DataFilter.build(request.args)
     if not (d_filter.has_municipalities() or d_filter.has_zone_filter()):
         raise InvalidUsage("No gm_code (deprecated) or zone_ids, municipalities.", status_code=400)
@@ -401,25 +717,136 @@ def get_public_zones():
     return jsonify(result)
 
 @app.route("/public/municipalities", methods=['GET'])
+@response_cache.cached("public_municipalities", static_ttl(3600))
 def get_municipalities():
-    conn = get_conn()
+    conn = get_read_conn()
     result = {}
     result["municipalities"] = zoneAdapter.list_municipalities(conn) 
     conn.commit()
     return jsonify(result)
 
+# Keyset pagination for list endpoints (see pagination.py), None when the client doesn't page.
+def get_pagination(d_filter):
+    if not pagination.is_requested(request.args):
+        return None
+    if streaming.is_requested(request.args):
+        raise InvalidUsage("page_size and cursor can't be combined with stream=true", status_code=400)
+    try:
+        return pagination.from_args(request.args, request.endpoint, d_filter)
+    except pagination.InvalidPagination as e:
+        raise InvalidUsage(str(e), status_code=400)
+
+# Projection on the fields= of the request (see projection.py), None when the client wants all fields.
+def get_projection(fields, known_fields=None):
+    if not projection.is_requested(request.args):
+        return None
+    try:
+        return projection.from_args(request.args, fields, known_fields)
+    except projection.InvalidProjection as e:
+        raise InvalidUsage(str(e), status_code=400)
+
+# Serializer for a row of a list, the projection's when the client asked for specific fields.
+def serializer(field_projection, serialize):
+    if field_projection:
+        return field_projection.serialize
+    return serialize
+
+# count_only=true returns only the number of rows of a list endpoint.
+def is_count_only():
+    if not projection.is_count_only(request.args):
+        return False
+    if projection.is_requested(request.args) or pagination.is_requested(request.args) or streaming.is_requested(request.args):
+        raise InvalidUsage("count_only=true can't be combined with fields, page_size, cursor or stream=true", status_code=400)
+    return True
+
+# Clusters instead of individual vehicles for zoomed out maps (see spatial_bins.py), None without cluster=.
+def get_clustering():
+    if not spatial_bins.is_cluster_requested(request.args):
+        return None
+    if pagination.is_requested(request.args) or streaming.is_requested(request.args):
+        raise InvalidUsage("cluster can't be combined with page_size, cursor or stream=true", status_code=400)
+    try:
+        return spatial_bins.from_zoom_args(request.args)
+    except spatial_bins.InvalidBins as e:
+        raise InvalidUsage(str(e), status_code=400)
+
+def get_heatmap_bins(d_filter):
+    try:
+        return spatial_bins.from_resolution_args(request.args, d_filter.get_bbox())
+    except spatial_bins.InvalidBins as e:
+        raise InvalidUsage(str(e), status_code=400)
+
+# Incremental sync of the parked vehicles (see sync.py), None without sync=true or since=<token>.
+# A sync is always about the current moment, the timestamp of the request is ignored.
+def get_sync(d_filter):
+    if not sync.is_requested(request.args):
+        return None
+    if pagination.is_requested(request.args) or streaming.is_requested(request.args) or spatial_bins.is_cluster_requested(request.args):
+        raise InvalidUsage("sync and since can't be combined with page_size, cursor, stream=true or cluster", status_code=400)
+    d_filter.timestamp = None
+    try:
+        return sync.from_args(request.args, request.endpoint, d_filter)
+    except sync.InvalidSyncToken as e:
+        raise InvalidUsage(str(e), status_code=400)
+
+def get_park_event_changes(conn, d_filter, vehicle_sync, public=False):
+    result = {}
+    result["added"], result["removed"] = parkEventsAdapter.get_park_event_changes(conn, d_filter, vehicle_sync, public)
+    result["initial"] = vehicle_sync.is_initial()
+    result["sync_token"] = vehicle_sync.next_token()
+    return result
+
+def check_bbox(d_filter):
+    if request.args.get("bbox") and not d_filter.has_bbox():
+        raise InvalidUsage("Invalid bbox, value should be sw_lng,sw_lat,ne_lng,ne_lat in degrees", status_code=400)
+
+# Returns (output_format, precision) for endpoints that support format=columnar.
+def get_output_format():
+    output_format = request.args.get("format", "default")
+    if output_format not in ("default", "columnar"):
+        raise InvalidUsage("Invalid format, value should be 'default' or 'columnar'", status_code=400)
+    precision = request.args.get("precision")
+    if precision is not None:
+        if not precision.isdigit() or int(precision) > 8:
+            raise InvalidUsage("Invalid precision, value should be an integer between 0 and 8", status_code=400)
+        precision = int(precision)
+    if output_format == "columnar" and streaming.is_requested(request.args):
+        raise InvalidUsage("format=columnar can't be combined with stream=true", status_code=400)
+    return output_format, precision
+
 @app.route("/public/vehicles_in_public_space", methods=['GET'])
+@response_cache.cached("public_vehicles_in_public_space", until_next_feed_import,
+    args=("format", "precision", "cluster", "zoom", "sync", "since"), ignore_timestamp=True)
 def get_vehicles_in_public_space():
-    conn = get_conn()
     d_filter = data_filter.DataFilter.build(request.args)
+    check_bbox(d_filter)
+    check_zone_ids(d_filter)
+    conn = get_read_conn()
+
+    vehicle_sync = get_sync(d_filter)
+    if vehicle_sync:
+        return jsonify(get_park_event_changes(conn, d_filter, vehicle_sync, public=True))
+
+    bins = get_clustering()
+    if bins:
+        result = {}
+        result["clusters"] = parkEventsAdapter.get_public_park_event_clusters(conn, d_filter, bins)
+        result["bins"] = bins.serialize()
+        return jsonify(result)
+
+    output_format, precision = get_output_format()
     
     result = {}
-    result["vehicles_in_public_space"] = parkEventsAdapter.get_public_park_events(conn, d_filter) 
+    if output_format == "columnar":
+        result["vehicles_in_public_space"] = parkEventsAdapter.get_public_park_events_columnar(conn, d_filter, precision)
+    else:
+        result["vehicles_in_public_space"] = parkEventsAdapter.get_public_park_events(conn, d_filter) 
     return jsonify(result)
 
 @app.route("/public/filters", methods=['GET'])
+@response_cache.cached("public_filters", static_ttl(3600))
 def get_filters():
-    conn = get_conn()
+    conn = get_read_conn()
     d_filter = data_filter.DataFilter.build(request.args)
     
     result = {}
@@ -429,45 +856,141 @@ def get_filters():
         result["filter_values"]["zones"] = zoneAdapter.list_zones(conn, d_filter, include_custom_zones=False)
     return jsonify(result)
 
+# Parses "52.0,5.0" into (latitude, longitude).
+def parse_location(location):
+    location_split = location.split(",")
+    if len(location_split) != 2:
+        raise InvalidUsage("Location not correctly formatted, '52.0,5.0' is expected", status_code=400)
+    try:
+        return float(location_split[0]), float(location_split[1])
+    except ValueError:
+        raise InvalidUsage("Location not correctly formatted, '52.0,5.0' is expected", status_code=400)
+
 @app.route("/public/get_municipality_based_on_latlng", methods=['GET'])
 def get_municipality_based_on_latlng():
-    conn = get_conn()
     location = request.args.get("location")
     if not location:
         raise InvalidUsage("No location specified", status_code=400)
-    location_split = location.split(",")
-    if len(location_split) != 2:
-        raise InvalidUsage("Location not correctly formatted, '52.0,5.0' is expected", status_code=400)
-    lat = location_split[0]
-    lng = location_split[1]
+    lat, lng = parse_location(location)
     
-    res = zoneAdapter.get_municipality_based_on_latlng(conn, lat, lng)
+    res = municipality_index.lookup(get_read_conn, lat, lng)
     if res == None:
         raise InvalidUsage("No municipality found for these coordinates", status_code=404)
     return jsonify(res)
 
+# Batch variant, expects {"locations": ["52.0,5.0", ...]} and returns the municipality
+# (or null) for every location in the same order.
+@app.route("/public/get_municipality_based_on_latlng", methods=['POST'])
+def get_municipalities_based_on_latlng():
+    try:
+        data = json.loads(request.data)
+    except:
+        raise InvalidUsage("invalid JSON", status_code=400)
+    if not isinstance(data, dict) or not isinstance(data.get("locations"), list):
+        raise InvalidUsage("No locations specified", status_code=400)
+    if len(data["locations"]) > municipality_lookup_max_locations:
+        raise InvalidUsage("Too many locations, at most %s are allowed" % municipality_lookup_max_locations, status_code=400)
+    locations = [parse_location(str(location)) for location in data["locations"]]
+
+    result = {}
+    result["municipalities"] = municipality_index.lookup_many(get_read_conn, locations)
+    return jsonify(result)
+
 @app.route("/park_events", methods=['GET'])
 @requires_auth
 def get_park_events():
-    conn = get_conn()
     d_filter = data_filter.DataFilter.build(request.args)
     authorized, error = g.acl.is_authorized(d_filter)
     if not authorized:
         return not_authorized(error)
+    check_bbox(d_filter)
+    check_zone_ids(d_filter)
+    conn = get_read_conn()
+
+    vehicle_sync = get_sync(d_filter)
+    if vehicle_sync:
+        return jsonify(get_park_event_changes(conn, d_filter, vehicle_sync))
+
+    bins = get_clustering()
+    if bins:
+        result = {}
+        result["clusters"] = parkEventsAdapter.get_park_event_clusters(conn, d_filter, bins)
+        result["bins"] = bins.serialize()
+        return jsonify(result)
+
+    if is_count_only():
+        result = {}
+        result["park_events_count"] = parkEventsAdapter.count_private_park_events(conn, d_filter)
+        return jsonify(result)
+
+    output_format, precision = get_output_format()
+    field_projection = get_projection(parkEventsAdapter.fields)
+
+    if streaming.is_requested(request.args):
+        cur = conn.cursor(name="park_events")
+        parkEventsAdapter.query_private_park_events(cur, d_filter, projection=field_projection)
+        return streaming.stream_json([("park_events", cur, serializer(field_projection, parkEventsAdapter.serialize_park_event))])
+
+    page = get_pagination(d_filter)
+    result = {}
+    if output_format == "columnar":
+        result["park_events"] = parkEventsAdapter.get_private_park_events_columnar(conn, d_filter, precision, page,
+            field_projection)
+    else:
+        result["park_events"] = parkEventsAdapter.get_private_park_events(conn, d_filter, page, field_projection) 
+    if page:
+        result["pagination"] = page.serialize()
+    return jsonify(result)
+
+
+# Vehicles within the map viewport bbox=sw_lng,sw_lat,ne_lng,ne_lat, with the filters and ACL of /park_events.
+@app.route("/vehicles/bbox", methods=['GET'])
+@requires_auth
+def get_vehicles_in_bbox():
+    d_filter = data_filter.DataFilter.build(request.args)
+    authorized, error = g.acl.is_authorized(d_filter)
+    if not authorized:
+        return not_authorized(error)
+    if not d_filter.has_bbox():
+        raise InvalidUsage("No valid bbox specified, value should be sw_lng,sw_lat,ne_lng,ne_lat in degrees", status_code=400)
+    check_zone_ids(d_filter)
+    conn = get_read_conn()
 
     result = {}
-    result["park_events"] = parkEventsAdapter.get_private_park_events(conn, d_filter) 
+    result["vehicles"], result["truncated"] = vehicleAdapter.get_vehicles_in_bbox(conn, d_filter)
+    conn.commit()
     return jsonify(result)
 
+@app.route("/tiles/park_events/<int:z>/<int:x>/<int:y>.mvt", methods=['GET'])
+@requires_auth
+def get_park_events_tile(z, x, y):
+    d_filter = data_filter.DataFilter.build(request.args)
+    authorized, error = g.acl.is_authorized(d_filter)
+    if not authorized:
+        return not_authorized(error)
+    check_zone_ids(d_filter)
+    conn = get_read_conn()
+
+    if z < 0 or z > 22 or x < 0 or y < 0 or x >= 2 ** z or y >= 2 ** z:
+        raise InvalidUsage("Invalid tile coordinates", status_code=400)
+    if not d_filter.get_timestamp():
+        d_filter.timestamp = datetime.datetime.now(datetime.timezone.utc)
+
+    tile = parkEventsAdapter.get_park_events_tile(conn, d_filter, z, x, y)
+    conn.commit()
+    response = app.response_class(tile, mimetype="application/vnd.mapbox-vector-tile")
+    response.headers["Cache-Control"] = "private, max-age=60"
+    return response
 
 @app.route("/v2/park_events/stats")
 @requires_auth
 def get_park_events_stats_v2():
-    conn = get_conn()
     d_filter = data_filter.DataFilter.build(request.args)
     authorized, error = g.acl.is_authorized(d_filter)
     if not authorized:
         return not_authorized(error)
+    check_zone_ids(d_filter)
+    conn = get_read_conn()
 
     result = {}
     result["park_event_stats"] = parkEventsAdapter.get_park_event_stats(conn, d_filter) 
@@ -476,9 +999,11 @@ def get_park_events_stats_v2():
 
 # In theory it's possible to retreive data from custom zones. That is not really a problem but can be fixed in the future.
 @app.route("/public/park_events/stats")
+@response_cache.cached("public_park_events_stats", until_next_feed_import_or_historic)
 def get_public_park_events_stats():
-    conn = get_conn()
     d_filter = data_filter.DataFilter.build(request.args)
+    check_zone_ids(d_filter)
+    conn = get_read_conn()
 
     result = {}
     result["park_event_stats"] = parkEventsAdapter.get_public_park_event_stats(conn, d_filter) 
@@ -487,7 +1012,6 @@ def get_public_park_events_stats():
 @app.route("/stats/generate_report")
 @requires_auth
 def get_report():
-    conn = get_conn()
     d_filter = data_filter.DataFilter.build(request.args)
     if not d_filter.has_gmcode():
         raise InvalidUsage("No municipality specified", status_code=400)
@@ -502,6 +1026,8 @@ def get_report():
     authorized, error = g.acl.check_operators(d_filter)
     if not authorized:
         return not_authorized(error)
+    check_zone_ids(d_filter)
+    conn = get_read_conn()
  
     raw_data, file_name = report.generate_xlsx.generate_report(conn, d_filter)
     return send_file(io.BytesIO(raw_data),
@@ -513,7 +1039,6 @@ def get_report():
 @app.route("/raw_data")
 @requires_auth
 def get_raw_data():
-    conn = get_conn()
     d_filter = data_filter.DataFilter.build(request.args)
     if not d_filter.get_start_time():
         raise InvalidUsage("No start_time specified", status_code=400)
@@ -532,8 +1057,9 @@ def get_raw_data():
     authorized = g.acl.is_authorized_for_raw_data()
     if not authorized:
         return not_authorized("This user is not admin and doesn't have raw data rights.")
+    check_zone_ids(d_filter)
 
-    audit_log.log_request(conn, g.acl.username, request.full_path, d_filter)
+    audit_log.log_request(get_conn(), g.acl.username, request.full_path, d_filter)
     with redis_helper.get_resource() as r:
         result = export_raw_data.create_export_task.schedule_export(r, d_filter, g.acl.username)
         return jsonify(result)
@@ -544,21 +1070,31 @@ def get_raw_data():
 @requires_auth
 def show_human_readable_permission():
     data = g.acl
-    conn = get_conn()
+    conn = get_read_conn()
     cur2 = conn.cursor()
     result = data.human_readable_serialize(cur2)
     # Store user stat in database
-    stats_active_users.register_active_user(conn, result)
+    stats_active_users.register_active_user(get_conn(), result)
     return jsonify(result)
 
+# Called after changes to users, organisations or data access grants, so they apply immediately.
+@app.route("/acl_cache", methods=['DELETE'])
+@requires_auth
+def invalidate_acl_cache():
+    if g.acl.organisation_type != "ADMIN":
+        return not_authorized("Only admins can invalidate the ACL cache.")
+    access_control.acl_cache.invalidate(request.args.get("user_id"))
+    return jsonify({"invalidated": True})
+
 @app.route("/aggregated_stats/available_vehicles")
 @requires_auth
 def get_aggregated_available_vehicles_stats():
-    conn = get_conn()
     d_filter = data_filter.DataFilter.build(request.args)
     authorized, error = g.acl.is_authorized(d_filter)
     if not authorized:
         return not_authorized(error)
+    check_zone_ids(d_filter)
+    conn = get_read_conn()
 
     if not request.args.get("aggregation_level"):
         raise InvalidUsage("No aggregation_level specified", status_code=400)
@@ -583,6 +1119,7 @@ def get_availability_stats():
     authorized, error = g.acl.is_authorized(d_filter)
     if not authorized:
         return not_authorized(error)
+    check_zone_ids(d_filter)
 
     if not request.args.get("aggregation_level"):
         raise InvalidUsage("No aggregation_level specified", status_code=400)
@@ -618,6 +1155,7 @@ def get_rental_stats():
     authorized, error = g.acl.is_authorized(d_filter)
     if not authorized:
         return not_authorized(error)
+    check_zone_ids(d_filter)
 
     if not request.args.get("aggregation_level"):
         raise InvalidUsage("No aggregation_level specified", status_code=400)
@@ -638,11 +1176,12 @@ def get_rental_stats():
 @app.route("/aggregated_stats/rentals")
 @requires_auth
 def get_aggregated_rental_stats():
-    conn = get_conn()
     d_filter = data_filter.DataFilter.build(request.args)
     authorized, error = g.acl.is_authorized(d_filter)
     if not authorized:
         return not_authorized(error)
+    check_zone_ids(d_filter)
+    conn = get_read_conn()
 
     if not request.args.get("aggregation_level"):
         raise InvalidUsage("No aggregation_level specified", status_code=400)
@@ -663,21 +1202,55 @@ def get_aggregated_rental_stats():
 @app.route("/parkeertelling", methods=['POST'])
 # @requires_auth
 def get_parkeertelling():
-    conn = get_conn()
+    conn = get_read_conn()
 
     try:
         request_data = json.loads(request.data)
     except:
         raise InvalidUsage("Invalid JSON", status_code=400)
 
+    if isinstance(request_data, dict) and "timestamps" in request_data:
+        features, timestamps = parse_parkeertelling_batch(request_data)
+        result = {}
+        result["features"] = parkEventsAdapter.batch_parkeertelling(conn, features, timestamps)
+        conn.commit()
+        return jsonify(result)
+
     d_filter = data_filter.DataFilter.build(request_data)
     result = parkEventsAdapter.parkeertelling(conn, d_filter)
     conn.commit()
     return jsonify(result)
 
+# Batch parkeertelling: {"geojson": <FeatureCollection of (Multi)Polygons>, "timestamps": [...]},
+# returns (features, [(timestamp as sent, datetime), ...]).
+def parse_parkeertelling_batch(request_data):
+    geojson = request_data.get("geojson")
+    if not isinstance(geojson, dict) or geojson.get("type") != "FeatureCollection" or not isinstance(geojson.get("features"), list):
+        raise InvalidUsage("geojson should be a FeatureCollection", status_code=400)
+    features = geojson["features"]
+    if len(features) == 0 or len(features) > parkeertelling_max_features:
+        raise InvalidUsage("geojson should have between 1 and %s features" % parkeertelling_max_features, status_code=400)
+    for feature in features:
+        geometry = feature.get("geometry") if isinstance(feature, dict) else None
+        if not isinstance(geometry, dict) or geometry.get("type") not in ("Polygon", "MultiPolygon"):
+            raise InvalidUsage("Every feature should have a Polygon or MultiPolygon geometry", status_code=400)
+
+    timestamps = request_data.get("timestamps")
+    if not isinstance(timestamps, list) or len(timestamps) == 0 or len(timestamps) > parkeertelling_max_timestamps:
+        raise InvalidUsage("timestamps should be a list of 1 to %s timestamps" % parkeertelling_max_timestamps, status_code=400)
+    parsed_timestamps = []
+    for timestamp in timestamps:
+        try:
+            parsed = datetime.datetime.strptime(timestamp, "%Y-%m-%dT%H:%M:%SZ").replace(tzinfo=datetime.timezone.utc)
+        except (TypeError, ValueError):
+            raise InvalidUsage("Invalid timestamp '%s', expected format is YYYY-MM-DDTHH:MM:SSZ" % timestamp, status_code=400)
+        if (timestamp, parsed) not in parsed_timestamps:
+            parsed_timestamps.append((timestamp, parsed))
+    return features, parsed_timestamps
+
 @app.route("/public/active_feeds")
 def get_active_feeds():
-    conn = get_conn()
+    conn = get_read_conn()
     cur = conn.cursor()
     stmt = """
      SELECT JSON_AGG(active_feeds.*) FROM (
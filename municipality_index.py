@@ -0,0 +1,68 @@
+import os
+import threading
+import time
+import shapely
+import zones
+
+# In-memory spatial index of the municipality zones, answers "which municipality is this point in"
+# without a database round trip.
+#
+# The polygons are loaded on the first lookup and reloaded after `ttl` seconds, municipality borders
+# are only changed by the importer, not through this API. Candidates are selected with an STRtree on the bounding boxes and
+# checked against prepared polygons.
+class MunicipalityIndex():
+    def __init__(self, ttl=3600):
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._loaded_at = None
+        self._index = None
+
+    # get_conn returns a database connection, it is only called when the index has to be (re)loaded.
+    def lookup(self, get_conn, latitude, longitude):
+        return self.lookup_many(get_conn, [(latitude, longitude)])[0]
+
+    # Returns the serialized municipality for every (latitude, longitude), None when a point is in no municipality.
+    def lookup_many(self, get_conn, locations):
+        tree, geometries, municipalities = self._get_index(get_conn)
+        result = [None] * len(locations)
+        if len(locations) == 0 or len(municipalities) == 0:
+            return result
+
+        points = shapely.points([longitude for _, longitude in locations], [latitude for latitude, _ in locations])
+        point_indices, municipality_indices = tree.query(points)
+        matches = shapely.intersects(geometries[municipality_indices], points[point_indices])
+        for point_index, municipality_index in zip(point_indices[matches], municipality_indices[matches]):
+            if result[point_index] is None:
+                result[point_index] = municipalities[municipality_index]
+        return result
+
+    def _get_index(self, get_conn):
+        with self._lock:
+            if self._loaded_at is None or time.monotonic() - self._loaded_at > self.ttl:
+                self._index = self._load(get_conn())
+                self._loaded_at = time.monotonic()
+            return self._index
+
+    def _load(self, conn):
+        stmt = """
+            SELECT zone_id, name, owner, municipality, zone_type, ST_AsBinary(area)
+            FROM zones
+            WHERE zone_type = 'municipality'
+            AND area IS NOT NULL
+            ORDER BY zone_id;
+        """
+        cur = conn.cursor()
+        cur.execute(stmt)
+        # A zone without a usable area can't contain a point, it's left out instead of failing the whole load.
+        rows = [row for row in cur.fetchall() if row[5] is not None]
+        conn.commit()
+
+        zone_adapter = zones.Zones()
+        municipalities = [zone_adapter.serialize_zone(row[:5]) for row in rows]
+        geometries = shapely.from_wkb([bytes(row[5]) for row in rows])
+        shapely.prepare(geometries)
+        print("Loaded %s municipalities in municipality index" % len(municipalities))
+        return shapely.STRtree(geometries), geometries, municipalities
+
+
+municipality_index = MunicipalityIndex(ttl=int(os.getenv("MUNICIPALITY_INDEX_TTL", 3600)))
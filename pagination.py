@@ -0,0 +1,114 @@
+import base64
+import binascii
+import hashlib
+import json
+import os
+from datetime import datetime
+
+max_page_size = int(os.getenv("MAX_PAGE_SIZE", 10000))
+
+param_types = [
+    ("page_after_time", "timestamptz"),
+    ("page_after_id", "bigint"),
+    ("page_limit", "integer")
+]
+
+class InvalidPagination(Exception):
+    pass
+
+# Keyset pagination on (time, id) for the list endpoints.
+#
+# Every page continues after the (time, id) of the last row of the previous page, so a page
+# costs an index range scan instead of OFFSET rows. The position is handed to the client as an
+# opaque cursor token, that is bound to the endpoint and the filter it was created for.
+# An endpoint can page through several lists at once (e.g. start and end rentals), the cursor
+# keeps a position per list and False for lists that are exhausted.
+class Pagination():
+    def __init__(self, page_size, fingerprint, positions=None):
+        self.page_size = page_size
+        self.fingerprint = fingerprint
+        self.positions = positions or {}
+        self.next_positions = {}
+
+    # Adds the page columns, the position condition and ORDER BY ... LIMIT to a QueryBuilder.
+    # The template should end its select list with {page_columns} and the statement with {page_order}.
+    def apply(self, query, name, time_column, id_column):
+        query.param_types = query.param_types + param_types
+        query.clause("page_columns", ", %s, %s" % (time_column, id_column))
+        position = self.positions.get(name)
+        if position is False:
+            query.where("false")
+        elif position:
+            query.where("(%s, %s) > ({page_after_time}, {page_after_id})" % (time_column, id_column),
+                page_after_time=datetime.fromisoformat(position[0]), page_after_id=position[1])
+        query.clause("page_order", "ORDER BY %s, %s LIMIT {page_limit}" % (time_column, id_column),
+            page_limit=self.page_size + 1)
+
+    # Returns the rows of this page of list `name` and remembers where the next page starts,
+    # the query fetched one row more than the page size to know if there is a next page.
+    def page(self, name, rows):
+        if len(rows) <= self.page_size:
+            self.next_positions[name] = False
+            return rows
+        rows = rows[:self.page_size]
+        self.next_positions[name] = [rows[-1][-2].isoformat(), rows[-1][-1]]
+        return rows
+
+    def next_cursor(self):
+        if all(position is False for position in self.next_positions.values()):
+            return None
+        data = {"f": self.fingerprint, "p": self.next_positions}
+        return base64.urlsafe_b64encode(json.dumps(data).encode()).decode()
+
+    def serialize(self):
+        data = {}
+        data["page_size"] = self.page_size
+        data["next_cursor"] = self.next_cursor()
+        return data
+
+# Applies the pagination of the request (or None) to a query, without pagination the slots stay empty.
+def apply(query, page, name, time_column, id_column):
+    if page is None:
+        query.clause("page_columns", "")
+        query.clause("page_order", "")
+        return
+    page.apply(query, name, time_column, id_column)
+
+def is_requested(args):
+    return args.get("page_size") is not None or args.get("cursor") is not None
+
+def is_valid_position(position):
+    if position is False:
+        return True
+    if not isinstance(position, list) or len(position) != 2 or not isinstance(position[1], int):
+        return False
+    try:
+        datetime.fromisoformat(position[0])
+    except (TypeError, ValueError):
+        return False
+    return True
+
+def get_fingerprint(endpoint, d_filter):
+    data = {"endpoint": endpoint, "filter": d_filter.to_canonical_dict()}
+    return hashlib.sha1(json.dumps(data, sort_keys=True).encode()).hexdigest()[:16]
+
+# Pagination for this request, raises InvalidPagination when page_size or cursor is invalid.
+def from_args(args, endpoint, d_filter):
+    page_size = args.get("page_size", str(max_page_size))
+    if not page_size.isdigit() or int(page_size) < 1 or int(page_size) > max_page_size:
+        raise InvalidPagination("Invalid page_size, value should be an integer between 1 and %s" % max_page_size)
+
+    fingerprint = get_fingerprint(endpoint, d_filter)
+    positions = None
+    if args.get("cursor"):
+        try:
+            data = json.loads(base64.urlsafe_b64decode(args.get("cursor").encode()))
+            positions = data["p"]
+            cursor_fingerprint = data["f"]
+        except (binascii.Error, ValueError, KeyError, TypeError):
+            raise InvalidPagination("Invalid cursor")
+        if cursor_fingerprint != fingerprint:
+            raise InvalidPagination("Cursor doesn't belong to this endpoint and filter")
+        if not isinstance(positions, dict) or not all(is_valid_position(position) for position in positions.values()):
+            raise InvalidPagination("Invalid cursor")
+    return Pagination(int(page_size), fingerprint, positions)
@@ -0,0 +1,4 @@
+-- Index for the removed park events of an incremental sync, see sync.py.
+-- The index on (end_time, park_event_id) for keyset pagination serves it as well.
+CREATE INDEX IF NOT EXISTS park_events_end_time_park_event_id_idx ON park_events (end_time, park_event_id);
+DROP INDEX IF EXISTS park_events_end_time_idx;
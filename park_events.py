@@ -4,139 +4,257 @@ import psycopg2.extras
 import zones
 from datetime import datetime, timedelta, timezone
 from flask import g
+import pagination
+import spatial_bins
+import sync
+from projection import Field, location_field, all_columns
+from query_builder import QueryBuilder, add_operator_filter, add_form_factor_filter
+from zone_geometries import zone_set_filter
 
 class ParkEvents():
     def __init__(self):
         self.zones = zones.Zones()
 
-    def get_private_park_events(self, conn, d_filter):
-        if d_filter.get_timestamp() <  datetime.now(timezone.utc) - timedelta(hours=36):
-            rows = self.get_park_events_long_term(conn, d_filter)
-            return self.serialize_park_events(rows)
-        rows = self.get_park_events_short_term(conn, d_filter)
+    filter_param_types = [
+        ("timestamp", "timestamptz"),
+        ("zone_ids", "integer[]"),
+        ("system_ids", "text[]"),
+        ("form_factors", "text[]"),
+        ("sw_lng", "float8"),
+        ("sw_lat", "float8"),
+        ("ne_lng", "float8"),
+        ("ne_lat", "float8")
+    ]
+
+    # Fields of a park event, in the order of serialize_park_event.
+    fields = [
+        Field("system_id", ["park_events.system_id"]),
+        Field("bike_id", ["bike_id"]),
+        location_field("location", "ST_Y(location)", "ST_X(location)"),
+        Field("start_time", ["start_time"]),
+        Field("end_time", ["end_time"]),
+        Field("form_factor", ["form_factor"])
+    ]
+
+    tile_param_types = [("z", "integer"), ("x", "integer"), ("y", "integer")]
+
+    # Query with only the filters that are set in d_filter, see query_builder.QueryBuilder.
+    def build_query(self, stmt, d_filter, param_types=None, **params):
+        query = QueryBuilder(stmt, param_types or self.filter_param_types, timestamp=d_filter.get_timestamp(), **params)
+        add_operator_filter(query, d_filter, "park_events.system_id")
+        add_form_factor_filter(query, d_filter)
+        return query
+
+    # The park event list and tiles filter on the parts of the zones in zone_part,
+    # and on the map viewport when a bbox is set.
+    def build_list_query(self, stmt, d_filter, param_types=None, **params):
+        query = self.build_query(stmt, d_filter, param_types, **params)
+        if d_filter.has_zone_filter():
+            query.where(zone_set_filter("location"), zone_ids=d_filter.get_zone_ids())
+        if d_filter.has_bbox():
+            sw_lng, sw_lat, ne_lng, ne_lat = d_filter.get_bbox()
+            query.where("location && ST_MakeEnvelope({sw_lng}, {sw_lat}, {ne_lng}, {ne_lat}, 4326)",
+                sw_lng=sw_lng, sw_lat=sw_lat, ne_lng=ne_lng, ne_lat=ne_lat)
+        return query
+
+    # page is a pagination.Pagination when the client pages through the park events,
+    # projection a projection.Projection when the client only wants some of the fields.
+    def get_private_park_events(self, conn, d_filter, page=None, projection=None):
+        rows = self.fetch_private_park_events(conn, d_filter, page, projection)
+        if projection:
+            return projection.serialize_rows(rows)
         return self.serialize_park_events(rows)
+
+    def fetch_private_park_events(self, conn, d_filter, page=None, projection=None):
+        cur = conn.cursor()
+        self.query_private_park_events(cur, d_filter, page, projection)
+        rows = cur.fetchall()
+        if page:
+            rows = page.page("park_events", rows)
+        return rows
+
+    def count_private_park_events(self, conn, d_filter):
+        cur = conn.cursor()
+        self.query_private_park_events(cur, d_filter, count_only=True)
+        return cur.fetchone()[0]
+
+    def query_private_park_events(self, cur, d_filter, page=None, projection=None, count_only=False):
+        if d_filter.get_timestamp() <  datetime.now(timezone.utc) - timedelta(hours=36):
+            self.query_park_events_long_term(cur, d_filter, page, projection, count_only)
+        else:
+            self.query_park_events_short_term(cur, d_filter, page, projection, count_only)
     
+    def get_private_park_events_columnar(self, conn, d_filter, precision=None, page=None, projection=None):
+        rows = self.fetch_private_park_events(conn, d_filter, page, projection)
+        if projection:
+            return projection.serialize_columnar(rows, precision)
+        return self.serialize_park_events_columnar(rows, precision)
+
     def get_public_park_events(self, conn, d_filter):
-        d_filter.timestamp = datetime.now(timezone.utc) 
-        rows = self.get_park_events_short_term(conn, d_filter)
-        return self.serialize_public_park_events(rows)
+        cur = conn.cursor()
+        self.query_public_park_events(cur, d_filter)
+        return self.serialize_public_park_events(cur.fetchall())
 
-    def get_park_events_long_term(self, conn, d_filter):
+    def get_public_park_events_columnar(self, conn, d_filter, precision=None):
         cur = conn.cursor()
-        stmt = """
-        WITH relevant_park_ids AS (
+        self.query_public_park_events(cur, d_filter)
+        return self.serialize_public_park_events_columnar(cur.fetchall(), precision)
+
+    def query_public_park_events(self, cur, d_filter):
+        d_filter.timestamp = datetime.now(timezone.utc) 
+        self.query_park_events_short_term(cur, d_filter)
+
+    # Park events that were parked on the date of the timestamp, used to speed up queries in the past.
+    relevant_park_ids = """
+        relevant_park_ids AS (
             SELECT UNNEST(park_event_ids) as park_event_id
             FROM park_event_on_date
             WHERE on_date = %(timestamp)s::date
         )
-        SELECT
-            park_events.system_id, 
-            bike_id, 
-	        ST_Y(location), ST_X(location), 
-	        start_time, 
-            end_time, 
-            form_factor
+    """
+
+    # Filters shared by the park event list and tile queries.
+    park_event_filters = """
+        start_time < %(timestamp)s
+        AND (end_time > %(timestamp)s OR end_time is null)
+        AND {filters}
+    """
+
+    def query_park_events_long_term(self, cur, d_filter, page=None, projection=None, count_only=False):
+        stmt = """
+        WITH """ + self.relevant_park_ids + """
+        SELECT {columns}{page_columns}
         FROM park_events
         LEFT JOIN vehicle_type 
         ON park_events.vehicle_type_id = vehicle_type.vehicle_type_id
         JOIN relevant_park_ids
         USING(park_event_id)
-        WHERE
-        start_time < %(timestamp)s
-        AND (end_time > %(timestamp)s OR end_time is null)
-        AND
-        (
-            false = %(has_zone_filter)s 
-            OR ST_WITHIN(location, 
-                (
-                    SELECT ST_UNION(area) 
-	                FROM zones 
-                    WHERE zone_id IN %(zone_ids)s
-                )
-            )
-        )
-        AND (
-            false = %(has_operator_filter)s 
-            OR park_events.system_id IN %(system_ids)s
+        WHERE """ + self.park_event_filters + """
+        {page_order};"""
+        query = self.build_list_query(stmt, d_filter)
+        self.select_columns(query, page, projection, count_only)
+        query.execute(cur)
+    
+    def query_park_events_short_term(self, cur, d_filter, page=None, projection=None, count_only=False):
+        stmt = """
+        SELECT {columns}{page_columns}
+        FROM park_events
+        LEFT JOIN vehicle_type 
+        ON park_events.vehicle_type_id = vehicle_type.vehicle_type_id
+        WHERE """ + self.park_event_filters + """
+        {page_order};"""
+        query = self.build_list_query(stmt, d_filter)
+        self.select_columns(query, page, projection, count_only)
+        query.execute(cur)
+
+    # Fills the {columns}, {page_columns} and {page_order} slots of the park event list queries.
+    def select_columns(self, query, page, projection, count_only):
+        if count_only:
+            query.clause("columns", "COUNT(*)")
+            pagination.apply(query, None, None, None, None)
+            return
+        query.clause("columns", projection.columns() if projection else all_columns(self.fields))
+        pagination.apply(query, page, "park_events", "park_events.start_time", "park_events.park_event_id")
+
+    # Mapbox Vector Tile with the park events within tile z/x/y, with the same filters as the park event list.
+    def get_park_events_tile(self, conn, d_filter, z, x, y):
+        is_long_term = d_filter.get_timestamp() <  datetime.now(timezone.utc) - timedelta(hours=36)
+        stmt = """
+        WITH tile AS (
+            SELECT ST_TileEnvelope(%(z)s, %(x)s, %(y)s) AS envelope
+        ),""" + (self.relevant_park_ids + "," if is_long_term else "") + """
+        tile_park_events AS (
+            SELECT
+                ST_AsMVTGeom(ST_Transform(location, 3857), tile.envelope) AS geom,
+                park_events.system_id, 
+                bike_id, 
+                EXTRACT(EPOCH FROM start_time)::bigint AS start_time,
+                form_factor
+            FROM park_events
+            CROSS JOIN tile
+            LEFT JOIN vehicle_type 
+            ON park_events.vehicle_type_id = vehicle_type.vehicle_type_id
+            """ + ("JOIN relevant_park_ids USING(park_event_id)" if is_long_term else "") + """
+            WHERE location && ST_Transform(tile.envelope, 4326)
+            AND """ + self.park_event_filters + """
         )
-        AND (
-            false = %(has_form_factor_filter)s 
-            OR (
-                form_factor in %(form_factors)s 
-                OR (
-                    true = %(include_unknown_form_factors)s 
-                    AND form_factor is null
-                )
-            )
-        );
+        SELECT ST_AsMVT(tile_park_events, 'park_events', 4096, 'geom')
+        FROM tile_park_events;
         """
-        cur.execute(stmt, {
-            "timestamp": d_filter.get_timestamp(),
-            "has_zone_filter": d_filter.has_zone_filter(),
-            "zone_ids": d_filter.get_zones(),
-            "has_operator_filter": d_filter.has_operator_filter(),
-            "system_ids": d_filter.get_operators(),
-            "has_form_factor_filter": d_filter.has_form_factor_filter(),
-            "form_factors": d_filter.get_form_factors(),
-            "include_unknown_form_factors": d_filter.include_unknown_form_factors()
-            }
-        )
-        return cur.fetchall()
-    
-    def get_park_events_short_term(self, conn, d_filter):
         cur = conn.cursor()
+        self.build_list_query(stmt, d_filter, self.filter_param_types + self.tile_param_types,
+            z=z, x=x, y=y).execute(cur)
+        tile = cur.fetchone()[0]
+        if tile is None:
+            return b""
+        return bytes(tile)
+
+    # Changes of the parked vehicles for a sync.Sync, returns (added, removed). Added are the park
+    # events that started since the previous sync and are still parked (all parked vehicles on the
+    # first sync), serialized with their park_event_id. Removed are the ids of park events that ended.
+    def get_park_event_changes(self, conn, d_filter, park_sync, public=False):
         stmt = """
-        SELECT
-            park_events.system_id, 
-            bike_id, 
-	        ST_Y(location), ST_X(location), 
-	        start_time, 
-            end_time, 
-            form_factor
+        SELECT park_events.park_event_id, """ + all_columns(self.fields) + """
         FROM park_events
         LEFT JOIN vehicle_type 
         ON park_events.vehicle_type_id = vehicle_type.vehicle_type_id
-        WHERE
-        start_time < %(timestamp)s
-        AND (end_time > %(timestamp)s OR end_time is null)
-        AND
-        (
-            false = %(has_zone_filter)s 
-            OR ST_WITHIN(location, 
-                (
-                    SELECT ST_UNION(area) 
-	                FROM zones 
-                    WHERE zone_id IN %(zone_ids)s
-                )
-            )
-        )
-        AND (
-            false = %(has_operator_filter)s 
-            OR park_events.system_id IN %(system_ids)s
-        )
-        AND (
-            false = %(has_form_factor_filter)s 
-            OR (
-                form_factor in %(form_factors)s 
-                OR (
-                    true = %(include_unknown_form_factors)s 
-                    AND form_factor is null
-                )
-            )
-        );
+        WHERE start_time < %(until)s
+        AND (end_time > %(until)s OR end_time is null)
+        AND {filters};
         """
-        cur.execute(stmt, {
-            "timestamp": d_filter.get_timestamp(),
-            "has_zone_filter": d_filter.has_zone_filter(),
-            "zone_ids": d_filter.get_zones(),
-            "has_operator_filter": d_filter.has_operator_filter(),
-            "system_ids": d_filter.get_operators(),
-            "has_form_factor_filter": d_filter.has_form_factor_filter(),
-            "form_factors": d_filter.get_form_factors(),
-            "include_unknown_form_factors": d_filter.include_unknown_form_factors()
-            }
-        )
-        return cur.fetchall()
+        query = self.build_list_query(stmt, d_filter, self.filter_param_types + sync.param_types,
+            until=park_sync.until)
+        if not park_sync.is_initial():
+            query.where("start_time > {since}", since=park_sync.get_changes_since())
+        cur = conn.cursor()
+        query.execute(cur)
+        serialize = self.serialize_public_park_event if public else self.serialize_park_event
+        added = []
+        for row in cur.fetchall():
+            data = serialize(row[1:])
+            data["park_event_id"] = row[0]
+            added.append(data)
+
+        if park_sync.is_initial():
+            return added, []
+
+        stmt = """
+        SELECT park_events.park_event_id
+        FROM park_events
+        LEFT JOIN vehicle_type 
+        ON park_events.vehicle_type_id = vehicle_type.vehicle_type_id
+        WHERE end_time > %(since)s
+        AND end_time <= %(until)s
+        AND {filters};
+        """
+        self.build_list_query(stmt, d_filter, self.filter_param_types + sync.param_types,
+            since=park_sync.get_changes_since(), until=park_sync.until).execute(cur)
+        removed = [row[0] for row in cur.fetchall()]
+        return added, removed
+
+    # Park events aggregated in spatial_bins.SpatialBins, with the count per operator and form factor
+    # per bin, for maps that are zoomed out too far to show every vehicle.
+    def get_park_event_clusters(self, conn, d_filter, bins):
+        is_long_term = d_filter.get_timestamp() <  datetime.now(timezone.utc) - timedelta(hours=36)
+        stmt = """
+        """ + ("WITH " + self.relevant_park_ids if is_long_term else "") + """
+        SELECT bin_i, bin_j, bin_latitude, bin_longitude, park_events.system_id, form_factor, COUNT(*)
+        FROM park_events
+        LEFT JOIN vehicle_type 
+        ON park_events.vehicle_type_id = vehicle_type.vehicle_type_id
+        """ + ("JOIN relevant_park_ids USING(park_event_id)" if is_long_term else "") + """
+        """ + bins.join("location") + """
+        WHERE """ + self.park_event_filters + """
+        GROUP BY bin_i, bin_j, bin_latitude, bin_longitude, park_events.system_id, form_factor;
+        """
+        cur = conn.cursor()
+        self.build_list_query(stmt, d_filter, self.filter_param_types + spatial_bins.param_types,
+            bin_size=bins.size).execute(cur)
+        return spatial_bins.serialize_bins(cur.fetchall(), ["operators", "form_factors"])
+
+    def get_public_park_event_clusters(self, conn, d_filter, bins):
+        d_filter.timestamp = datetime.now(timezone.utc)
+        return self.get_park_event_clusters(conn, d_filter, bins)
 
     # Fill array with data.
     def extract_stat(self, records):
@@ -165,6 +283,32 @@ class ParkEvents():
         data["form_factor"] = park_event[6]
         return data
 
+    # Columnar format: one array per field instead of an object per park event,
+    # coordinates are rounded to `precision` decimals when it's set.
+    def serialize_park_events_columnar(self, park_events, precision=None):
+        data = {}
+        data["system_id"] = [park_event[0] for park_event in park_events]
+        data["bike_id"] = [park_event[1] for park_event in park_events]
+        data["latitude"] = self.round_coordinates([park_event[2] for park_event in park_events], precision)
+        data["longitude"] = self.round_coordinates([park_event[3] for park_event in park_events], precision)
+        data["start_time"] = [park_event[4] for park_event in park_events]
+        data["end_time"] = [park_event[5] for park_event in park_events]
+        data["form_factor"] = [park_event[6] for park_event in park_events]
+        return data
+
+    def serialize_public_park_events_columnar(self, park_events, precision=None):
+        data = {}
+        data["system_id"] = [park_event[0] for park_event in park_events]
+        data["latitude"] = self.round_coordinates([park_event[2] for park_event in park_events], precision)
+        data["longitude"] = self.round_coordinates([park_event[3] for park_event in park_events], precision)
+        data["form_factor"] = [park_event[6] for park_event in park_events]
+        return data
+
+    def round_coordinates(self, coordinates, precision):
+        if precision is None:
+            return coordinates
+        return [round(coordinate, precision) for coordinate in coordinates]
+
     def serialize_public_park_events(self, park_events):
         result = []
         for park_event in park_events:
@@ -202,30 +346,17 @@ class ParkEvents():
                 (SELECT date_trunc('hour', %(timestamp)s - start_time) as datef, zone_id,
                     count(1) as sum_bikes
                 FROM (
-                        SELECT start_time, park_events.system_id, zones.zone_id 
+                        SELECT start_time, park_events.system_id, park_event_zone.zone_id 
                         FROM park_events
-                        JOIN zones
-                        ON ST_WITHIN(location, area)
+                        JOIN park_event_zone
+                        USING(park_event_id)
                         LEFT JOIN vehicle_type 
                         USING(vehicle_type_id)
                         WHERE 
                         start_time < %(timestamp)s
                         AND (end_time > %(timestamp)s OR end_time is null)
-                        AND (
-                            false = %(has_operator_filter)s 
-                            OR park_events.system_id IN %(system_ids)s
-                        )
-                        AND (
-                            false = %(has_form_factor_filter)s 
-                            OR (
-                                form_factor in %(form_factors)s 
-                                OR (
-                                    true = %(include_unknown_form_factors)s 
-                                    AND form_factor is null
-                                )
-                            )
-                        )
-                        AND zone_id in %(zone_ids)s
+                        AND {filters}
+                        AND park_event_zone.zone_id = ANY(%(zone_ids)s)
                     ) AS q1
                     GROUP BY datef, zone_id, system_id) q1
                 GROUP BY zone_id, bucket
@@ -240,19 +371,9 @@ class ParkEvents():
             FROM zones
             LEFT JOIN grouped_park_event_stats
             USING(zone_id)
-            WHERE zones.zone_id in %(zone_ids)s;
+            WHERE zones.zone_id = ANY(%(zone_ids)s);
         """
-        zone_ids = tuple([zone_id for zone_id in  d_filter.get_zones()])
-        cur.execute(stmt, {
-            "timestamp": d_filter.get_timestamp(),
-            "zone_ids": zone_ids,
-            "has_operator_filter": d_filter.has_operator_filter(),
-            "system_ids": d_filter.get_operators(),
-            "has_form_factor_filter": d_filter.has_form_factor_filter(),
-            "form_factors": d_filter.get_form_factors(),
-            "include_unknown_form_factors": d_filter.include_unknown_form_factors()
-            }
-        )
+        self.build_query(stmt, d_filter, zone_ids=d_filter.get_zone_ids()).execute(cur)
         rows = cur.fetchall()
         result_zones = []
         for zone in rows:
@@ -281,10 +402,10 @@ class ParkEvents():
                 (SELECT date_trunc('hour', %(timestamp)s - start_time) as datef, zone_id,
                     count(1) as sum_bikes
                 FROM (
-                        SELECT start_time, park_events.system_id, zones.zone_id 
+                        SELECT start_time, park_events.system_id, park_event_zone.zone_id 
                         FROM park_events
-                        JOIN zones
-                        ON ST_WITHIN(location, area)
+                        JOIN park_event_zone
+                        USING(park_event_id)
                         LEFT JOIN vehicle_type 
                         USING(vehicle_type_id)
                         JOIN relevant_park_ids
@@ -292,21 +413,8 @@ class ParkEvents():
                         WHERE
                         start_time < %(timestamp)s
                         AND (end_time > %(timestamp)s OR end_time is null)
-                        AND (
-                            false = %(has_operator_filter)s 
-                            OR park_events.system_id IN %(system_ids)s
-                        )
-                        AND (
-                            false = %(has_form_factor_filter)s 
-                            OR (
-                                form_factor in %(form_factors)s 
-                                OR (
-                                    true = %(include_unknown_form_factors)s 
-                                    AND form_factor is null
-                                )
-                            )
-                        )
-                        AND zone_id in %(zone_ids)s
+                        AND {filters}
+                        AND park_event_zone.zone_id = ANY(%(zone_ids)s)
                     ) AS q1
                     GROUP BY datef, zone_id, system_id) q1
                 GROUP BY zone_id, bucket
@@ -321,19 +429,9 @@ class ParkEvents():
             FROM zones
             LEFT JOIN grouped_park_event_stats
             USING(zone_id)
-            WHERE zones.zone_id in %(zone_ids)s;
+            WHERE zones.zone_id = ANY(%(zone_ids)s);
         """
-        zone_ids = tuple([zone_id for zone_id in  d_filter.get_zones()])
-        cur.execute(stmt, {
-            "timestamp": d_filter.get_timestamp(),
-            "zone_ids": zone_ids,
-            "has_operator_filter": d_filter.has_operator_filter(),
-            "system_ids": d_filter.get_operators(),
-            "has_form_factor_filter": d_filter.has_form_factor_filter(),
-            "form_factors": d_filter.get_form_factors(),
-            "include_unknown_form_factors": d_filter.include_unknown_form_factors()
-            }
-        )
+        self.build_query(stmt, d_filter, zone_ids=d_filter.get_zone_ids()).execute(cur)
         rows = cur.fetchall()
         result_zones = []
         for zone in rows:
@@ -451,3 +549,54 @@ class ParkEvents():
 
         return cur.fetchall()
 
+
+    # Batch parkeertelling: the parked vehicles per form factor within every feature of a GeoJSON
+    # FeatureCollection, for every timestamp. All features are counted in one query per timestamp,
+    # instead of a ST_WITHIN scan (and an unnest of park_event_on_date) per feature.
+    # timestamps is a list of (key, datetime), returns per feature its name and per timestamp key
+    # the [form_factor, number_of_parked_vehicles] rows like parkeertelling.
+    def batch_parkeertelling(self, conn, features, timestamps):
+        geometries = [json.dumps(feature["geometry"]) for feature in features]
+        results = []
+        for feature in features:
+            data = {}
+            data["name"] = (feature.get("properties") or {}).get("name")
+            data["counts"] = {key: [] for key, _ in timestamps}
+            results.append(data)
+
+        cur = conn.cursor()
+        for key, timestamp in timestamps:
+            is_long_term = timestamp < datetime.now(timezone.utc) - timedelta(hours=36)
+            stmt = """
+                WITH features AS (
+                    SELECT feature_index - 1 AS feature_index,
+                        ST_SetSRID(ST_GeomFromGeoJSON(geometry), 4326) AS geom
+                    FROM unnest(%(geometries)s::text[]) WITH ORDINALITY AS feature(geometry, feature_index)
+                )""" + (""",
+                relevant_park_ids AS (
+                    SELECT UNNEST(park_event_ids) as park_event_id
+                    FROM park_event_on_date
+                    WHERE on_date = %(timestamp)s::date
+                )""" if is_long_term else "") + """
+                SELECT
+                feature_index,
+                form_factor,
+                COUNT(bike_id) as number_of_parked_vehicles
+                FROM features
+                JOIN park_events
+                ON ST_WITHIN(location, features.geom)
+                LEFT JOIN vehicle_type 
+                ON park_events.vehicle_type_id = vehicle_type.vehicle_type_id
+                """ + ("JOIN relevant_park_ids USING(park_event_id)" if is_long_term else "") + """
+                WHERE 
+                start_time < %(timestamp)s
+                AND (end_time > %(timestamp)s OR end_time is null)
+                GROUP BY feature_index, form_factor;
+            """
+            cur.execute(stmt, {
+                "timestamp": timestamp,
+                "geometries": geometries
+            })
+            for feature_index, form_factor, number_of_parked_vehicles in cur.fetchall():
+                results[feature_index]["counts"][key].append([form_factor, number_of_parked_vehicles])
+        return results
@@ -0,0 +1,100 @@
+import os
+import re
+import threading
+from collections import OrderedDict
+import psycopg2
+import psycopg2.errors
+
+# Statements are named after their text (see query_builder.QueryBuilder), so the number of names
+# grows with the filter combinations clients use. The registry keeps the most recently used ones,
+# a connection that prepared more than this deallocates all its statements and starts over.
+max_statements = int(os.getenv("PREPARED_STATEMENTS_MAX", 500))
+
+# Registry of server side prepared statements.
+#
+# Statements are written with %(name)s placeholders like any other query in this repo,
+# param_types lists the parameters with their PostgreSQL type, parameters the statement doesn't use are skipped.
+# Every statement is prepared once per pooled connection (see db_pool.PooledConnection) and executed
+# with EXECUTE afterwards. Connections that are not pooled and named (server side) cursors fall back
+# to executing the statement text.
+class PreparedStatementRegistry():
+    def __init__(self, max_statements=max_statements):
+        self.max_statements = max_statements
+        self._lock = threading.Lock()
+        self._statements = OrderedDict()
+        self._stats = OrderedDict()
+
+    def execute(self, cur, name, stmt, params, param_types):
+        prepared_names = getattr(cur.connection, "prepared_statements", None)
+        if prepared_names is None or cur.name is not None:
+            self._count(name, "fallbacks")
+            cur.execute(stmt, params)
+            return
+
+        prepare_stmt, execute_stmt = self._get_statement(name, stmt, param_types)
+        if name not in prepared_names:
+            if len(prepared_names) >= self.max_statements:
+                self._deallocate_all(cur, prepared_names)
+            cur.execute(prepare_stmt)
+            prepared_names.add(name)
+            self._count(name, "plans")
+
+        try:
+            cur.execute(execute_stmt, params)
+        except psycopg2.errors.InvalidSqlStatementName:
+            # The statement disappeared from the session (e.g. DISCARD ALL), the other names may
+            # be gone as well, so start over with no prepared statements at all.
+            cur.connection.rollback()
+            self._deallocate_all(cur, prepared_names)
+            cur.execute(prepare_stmt)
+            prepared_names.add(name)
+            self._count(name, "plans")
+            cur.execute(execute_stmt, params)
+        self._count(name, "executions")
+
+    def _deallocate_all(self, cur, prepared_names):
+        cur.execute("DEALLOCATE ALL")
+        prepared_names.clear()
+
+    def _get_statement(self, name, stmt, param_types):
+        with self._lock:
+            if name in self._statements:
+                self._statements.move_to_end(name)
+                return self._statements[name]
+            self._statements[name] = self._convert(name, stmt, param_types)
+            if len(self._statements) > self.max_statements:
+                self._statements.popitem(last=False)
+            return self._statements[name]
+
+    # Converts a statement with %(name)s placeholders into a PREPARE and an EXECUTE statement.
+    def _convert(self, name, stmt, param_types):
+        param_types = [(param, param_type) for param, param_type in param_types if "%%(%s)s" % param in stmt]
+        positions = {}
+        for index, (param, _) in enumerate(param_types):
+            positions[param] = index + 1
+
+        def to_positional(match):
+            return "$%d" % positions[match.group(1)]
+
+        body = re.sub(r"%\((\w+)\)s", to_positional, stmt).replace("%%", "%")
+        types = ", ".join(param_type for _, param_type in param_types)
+        prepare_stmt = "PREPARE %s (%s) AS %s" % (name, types, body)
+        execute_stmt = "EXECUTE %s (%s)" % (name, ", ".join("%%(%s)s" % param for param, _ in param_types))
+        return prepare_stmt, execute_stmt
+
+    def _count(self, name, counter):
+        with self._lock:
+            if name not in self._stats:
+                self._stats[name] = {"plans": 0, "executions": 0, "fallbacks": 0}
+                if len(self._stats) > self.max_statements:
+                    self._stats.popitem(last=False)
+            else:
+                self._stats.move_to_end(name)
+            self._stats[name][counter] += 1
+
+    def stats(self):
+        with self._lock:
+            return {name: dict(counters) for name, counters in self._stats.items()}
+
+
+statement_registry = PreparedStatementRegistry()
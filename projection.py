@@ -0,0 +1,82 @@
+# Field projection for the list endpoints: with fields=system_id,start_location only the SQL
+# expressions of those fields are computed and fetched, count_only=true only counts the rows.
+
+class InvalidProjection(Exception):
+    pass
+
+def location(values):
+    return {"latitude": values[0], "longitude": values[1]}
+
+def single(values):
+    return values[0]
+
+# A field of a list endpoint: the SQL expressions it needs and how their values are serialized.
+# Fields with more than one column have `columnar_names`, the names of their arrays in format=columnar.
+class Field():
+    def __init__(self, name, columns, serialize=single, columnar_names=None):
+        self.name = name
+        self.columns = columns
+        self.serialize = serialize
+        self.columnar_names = columnar_names or [name]
+
+def location_field(name, latitude, longitude):
+    return Field(name, [latitude, longitude], location, ["latitude", "longitude"])
+
+# Select list of all fields, in order. Used by the adapters for the full rows, so the
+# positional serializers of the adapters keep working.
+def all_columns(fields):
+    return ", ".join(column for field in fields for column in field.columns)
+
+class Projection():
+    def __init__(self, fields):
+        self.fields = fields
+
+    # A list that has none of the requested fields still selects a column, the page columns follow it.
+    def columns(self):
+        return all_columns(self.fields) or "NULL"
+
+    def serialize(self, row):
+        data = {}
+        index = 0
+        for field in self.fields:
+            data[field.name] = field.serialize(row[index:index + len(field.columns)])
+            index += len(field.columns)
+        return data
+
+    def serialize_rows(self, rows):
+        return [self.serialize(row) for row in rows]
+
+    # Coordinates (fields with more than one column) are rounded to `precision` decimals when it's set.
+    def serialize_columnar(self, rows, precision=None):
+        data = {}
+        index = 0
+        for field in self.fields:
+            for name in field.columnar_names:
+                values = [row[index] for row in rows]
+                if precision is not None and len(field.columns) > 1:
+                    values = [round(value, precision) if value is not None else None for value in values]
+                data[name] = values
+                index += 1
+        return data
+
+def is_requested(args):
+    return args.get("fields") is not None
+
+def is_count_only(args):
+    return args.get("count_only") == "true"
+
+# Projection on the requested fields, raises InvalidProjection for unknown fields.
+# Endpoints that return several lists pass the fields of all lists as `known_fields`,
+# requested fields that the list doesn't have are left out of its projection.
+def from_args(args, fields, known_fields=None):
+    known_names = [field.name for field in (known_fields or fields)]
+    fields_by_name = {field.name: field for field in fields}
+    requested = []
+    for name in args.get("fields").split(","):
+        name = name.strip()
+        if name not in known_names:
+            raise InvalidProjection("Unknown field '%s', available fields are: %s" %
+                (name, ", ".join(dict.fromkeys(known_names))))
+        if name in fields_by_name and fields_by_name[name] not in requested:
+            requested.append(fields_by_name[name])
+    return Projection(requested)
@@ -0,0 +1,179 @@
+import os
+import select
+import socket
+import threading
+import time
+import psycopg2
+import psycopg2.extensions
+
+try:
+    import uwsgi
+except ImportError:
+    uwsgi = None
+
+# Time budget per endpoint in milliseconds, endpoints without an entry get the default budget.
+# Both can be overridden with QUERY_BUDGET_DEFAULT_MS and QUERY_BUDGETS="get_trips=60000,get_rentals=20000".
+default_budget_ms = int(os.getenv("QUERY_BUDGET_DEFAULT_MS", 20000))
+budgets_ms = {
+    "get_trips": 30000,
+    "get_trips_stats": 30000,
+    "get_trips_origins": 30000,
+    "get_trips_destinations": 30000,
+    "get_rentals": 30000,
+    "get_rentals_stats": 30000,
+    "get_park_events": 15000,
+    "get_park_events_stats_v2": 15000,
+    "get_vehicles_in_public_space": 10000,
+    "get_public_park_events_stats": 10000,
+    "get_report": 120000,
+    # Creating a zone fills its membership of all park events and trips in the same transaction.
+    "insert_zone": 300000
+}
+# Budget of a streamed response (stream=true), counted from the moment streaming starts.
+stream_budget_ms = int(os.getenv("QUERY_BUDGET_STREAM_MS", 600000))
+
+# Cancel queries when the HTTP client disconnected. Only enable this when uWSGI serves the clients
+# itself with http-socket=, with http= (uwsgi.ini) the connection fd belongs to the router.
+detect_disconnect = os.getenv("QUERY_BUDGET_DETECT_DISCONNECT") == "true"
+
+if os.getenv("QUERY_BUDGETS"):
+    for item in os.getenv("QUERY_BUDGETS").split(","):
+        endpoint, _, budget = item.partition("=")
+        budgets_ms[endpoint.strip()] = int(budget)
+
+# Deadline for all queries of one request.
+#
+# Every statement on a connection of the request runs with statement_timeout set to the remaining
+# budget (see db_pool.PooledCursor), the monitor thread cancels running queries when the deadline
+# passes or the HTTP client disconnected.
+class QueryBudget():
+    def __init__(self, name, budget_ms, client_fd=None):
+        self.name = name
+        self.budget_ms = budget_ms
+        self.deadline = time.monotonic() + budget_ms / 1000
+        self.cancel_reason = None
+        self._client_fd = client_fd
+        self._connections = []
+        self._lock = threading.Lock()
+
+    def remaining_ms(self):
+        return max(int((self.deadline - time.monotonic()) * 1000), 1)
+
+    def remaining_seconds(self):
+        return self.remaining_ms() / 1000
+
+    # SET LOCAL only lasts until the end of the transaction, so nothing has to be reset when the
+    # connection goes back to the pool.
+    def timeout_statement(self):
+        return "SET LOCAL statement_timeout = %d" % self.remaining_ms()
+
+    # Starts a new deadline `budget_ms` from now, streamed responses fetch rows long after the view
+    # returned and get their own budget instead of the one of the endpoint. The FETCHes of open
+    # named cursors run in a transaction that already has a timeout, that is raised to the new budget.
+    def restart(self, name, budget_ms):
+        self.name = name
+        self.budget_ms = budget_ms
+        self.deadline = time.monotonic() + budget_ms / 1000
+        with self._lock:
+            connections = list(self._connections)
+        for conn in connections:
+            if conn.closed or conn.info.transaction_status != psycopg2.extensions.TRANSACTION_STATUS_INTRANS:
+                continue
+            try:
+                psycopg2.extensions.cursor(conn).execute(self.timeout_statement())
+            except psycopg2.Error:
+                # The transaction is aborted now, the next FETCH reports the error.
+                pass
+
+    def serialize(self):
+        data = {}
+        data["budget"] = self.name
+        data["budget_ms"] = self.budget_ms
+        return data
+
+    def apply(self, conn):
+        conn.query_budget = self
+        with self._lock:
+            self._connections.append(conn)
+
+    # The pool rolls back an open transaction when the connection is returned, which also drops
+    # the SET LOCAL timeout.
+    def release(self, conn):
+        conn.query_budget = None
+        with self._lock:
+            if conn in self._connections:
+                self._connections.remove(conn)
+
+    # Cancels the running queries once. Statements started after the deadline get a statement_timeout
+    # of 1 ms (remaining_ms() doesn't go below that), so they fail right away as well.
+    def check(self):
+        if self.cancel_reason is not None:
+            return
+        if time.monotonic() >= self.deadline:
+            self.cancel_reason = "deadline"
+        elif self._client_disconnected():
+            self.cancel_reason = "client_disconnected"
+        if self.cancel_reason is None:
+            return
+        with self._lock:
+            connections = list(self._connections)
+        for conn in connections:
+            try:
+                conn.cancel()
+            except psycopg2.Error:
+                pass
+
+    def _client_disconnected(self):
+        if self._client_fd is None:
+            return False
+        try:
+            readable, _, _ = select.select([self._client_fd], [], [], 0)
+            if not readable:
+                return False
+            client = socket.fromfd(self._client_fd, socket.AF_INET, socket.SOCK_STREAM)
+            try:
+                return client.recv(1, socket.MSG_PEEK | socket.MSG_DONTWAIT) == b""
+            finally:
+                client.close()
+        except (OSError, ValueError):
+            return False
+
+# Single background thread that checks all running budgets.
+class BudgetMonitor():
+    def __init__(self, interval=0.25):
+        self.interval = interval
+        self._budgets = set()
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def start(self, endpoint):
+        budget = QueryBudget(endpoint, budgets_ms.get(endpoint, default_budget_ms), self._client_fd())
+        with self._lock:
+            self._budgets.add(budget)
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="query-budget-monitor", daemon=True)
+                self._thread.start()
+        return budget
+
+    def finish(self, budget):
+        with self._lock:
+            self._budgets.discard(budget)
+
+    def _client_fd(self):
+        if uwsgi is None or not detect_disconnect:
+            return None
+        try:
+            return uwsgi.connection_fd()
+        except Exception:
+            return None
+
+    def _run(self):
+        while True:
+            time.sleep(self.interval)
+            with self._lock:
+                budgets = list(self._budgets)
+            for budget in budgets:
+                budget.check()
+
+
+budget_monitor = BudgetMonitor()
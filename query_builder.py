@@ -0,0 +1,82 @@
+import hashlib
+import string
+from psycopg2 import sql
+from prepared_statements import statement_registry
+
+# Composes a statement from a template and only the filters that are active for a request.
+#
+# Generic predicates like (false = %(has_operator_filter)s OR system_id = ANY(%(system_ids)s))
+# hide the actual filter from the planner, so it can't use an index for it or prune partitions.
+# The template has {name} slots, where() adds a condition to a slot (default "filters"), the
+# conditions of a slot are joined with AND and an empty slot renders as true. clause() puts a
+# piece of SQL in a slot as is, e.g. extra columns or ORDER BY ... LIMIT.
+# Conditions refer to their parameters as {name} fields, those are rendered as %(name)s placeholders.
+# Other parameters of the template are written as %(name)s and passed to the constructor.
+#
+# Only SQL and Placeholder are composed, so the statement can be rendered without a connection.
+# Requests with the same active filters get the same statement text, its fingerprint is used as
+# the name of the prepared statement.
+class QueryBuilder():
+    def __init__(self, template, param_types, **params):
+        self.template = template
+        self.param_types = param_types
+        self.params = params
+        self.conditions = {}
+        self.clauses = {}
+
+    def where(self, condition, slot="filters", **params):
+        placeholders = {param: sql.Placeholder(param) for param in params}
+        self.conditions.setdefault(slot, []).append(sql.SQL(condition).format(**placeholders))
+        self.params.update(params)
+        return self
+
+    def clause(self, slot, clause, **params):
+        placeholders = {param: sql.Placeholder(param) for param in params}
+        self.clauses[slot] = sql.SQL(clause).format(**placeholders)
+        self.params.update(params)
+        return self
+
+    def render(self):
+        slots = {}
+        for _, slot, _, _ in string.Formatter().parse(self.template):
+            if slot is None:
+                continue
+            if slot in self.clauses:
+                slots[slot] = self.clauses[slot]
+                continue
+            conditions = self.conditions.get(slot, [])
+            if conditions:
+                slots[slot] = sql.SQL("\n            AND ").join(conditions)
+            else:
+                slots[slot] = sql.SQL("true")
+        return sql.SQL(self.template).format(**slots).as_string(None)
+
+    # Name of the prepared statement, pass the rendered statement when it's already rendered.
+    def fingerprint(self, stmt=None):
+        if stmt is None:
+            stmt = self.render()
+        return "q_" + hashlib.sha1(stmt.encode()).hexdigest()[:20]
+
+    # Statements are prepared per connection by default, prepare=False runs the statement text
+    # (for queries where a generic plan is worse, like time_bucket_gapfill).
+    def execute(self, cur, prepare=True):
+        stmt = self.render()
+        if not prepare:
+            cur.execute(stmt, self.params)
+            return
+        statement_registry.execute(cur, self.fingerprint(stmt), stmt, self.params, self.param_types)
+
+# Filters from DataFilter that have the same form in every adapter.
+def add_operator_filter(query, d_filter, column="system_id", slot="filters"):
+    if d_filter.has_operator_filter():
+        query.where(column + " = ANY({system_ids})", slot=slot, system_ids=list(d_filter.get_operators()))
+
+def add_form_factor_filter(query, d_filter, slot="filters"):
+    if not d_filter.has_form_factor_filter():
+        return
+    if d_filter.include_unknown_form_factors():
+        query.where("(form_factor::text = ANY({form_factors}) OR form_factor IS NULL)", slot=slot,
+            form_factors=list(d_filter.get_form_factors()))
+    else:
+        query.where("form_factor::text = ANY({form_factors})", slot=slot,
+            form_factors=list(d_filter.get_form_factors()))
@@ -0,0 +1,64 @@
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+def run_sequentially(conn, calls):
+    return [call(conn) for call in calls]
+
+# Runs independent adapter calls concurrently, each call is a function that takes a connection.
+#
+# The calls are spread over the request's own connection and up to `max_extra_connections`
+# extra connections. Extra connections are only taken when the pool has one available right away,
+# when none is available the calls simply run one after another on the request's connection.
+class QueryExecutor():
+    def __init__(self, max_workers=8, max_extra_connections=3):
+        self.max_extra_connections = max_extra_connections
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="query-executor")
+
+    # checkout() returns a handle with the connection as handle[1] or None, release(handle) returns it.
+    def run(self, conn, calls, checkout, release):
+        if len(calls) < 2:
+            return run_sequentially(conn, calls)
+
+        handles = []
+        while len(handles) < min(self.max_extra_connections, len(calls) - 1):
+            handle = checkout()
+            if handle is None:
+                break
+            handles.append(handle)
+
+        connections = [conn] + [handle[1] for handle in handles]
+        chunks = [[] for _ in connections]
+        for index in range(len(calls)):
+            chunks[index % len(connections)].append(index)
+
+        results = [None] * len(calls)
+        try:
+            futures = []
+            for chunk_conn, chunk in zip(connections[1:], chunks[1:]):
+                futures.append(self._executor.submit(self._run_chunk, chunk_conn, calls, chunk, results))
+            error = None
+            try:
+                self._run_chunk(conn, calls, chunks[0], results)
+            except Exception as e:
+                error = e
+            for future in futures:
+                try:
+                    future.result()
+                except Exception as e:
+                    error = error or e
+            if error is not None:
+                raise error
+        finally:
+            for handle in handles:
+                release(handle)
+        return results
+
+    def _run_chunk(self, conn, calls, chunk, results):
+        for index in chunk:
+            results[index] = calls[index](conn)
+        conn.commit()
+
+
+query_executor = QueryExecutor(
+    max_workers=int(os.getenv("QUERY_EXECUTOR_WORKERS", 8)),
+    max_extra_connections=int(os.getenv("QUERY_EXECUTOR_MAX_EXTRA_CONNECTIONS", 3)))
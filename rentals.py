@@ -2,115 +2,167 @@ import json
 from bson import json_util
 import psycopg2.extras
 import zones
+import pagination
+from projection import Field, location_field, all_columns
+from query_builder import QueryBuilder, add_operator_filter
+from zone_geometries import zone_set_filter
 
 class Rentals():
     def __init__(self):
         self.zones = zones.Zones()
 
-    def get_start_trips(self, conn, d_filter):
+    filter_param_types = [
+        ("start_time", "timestamptz"),
+        ("end_time", "timestamptz"),
+        ("zone_ids", "integer[]"),
+        ("system_ids", "text[]")
+    ]
+
+    # Fields of a start and an end rental, in the order of serialize_rental.
+    start_fields = [
+        Field("system_id", ["system_id"]),
+        Field("bike_id", ["bike_id"]),
+        location_field("location", "st_y(location)", "st_x(location)"),
+        Field("departure_time", ["start_time"])
+    ]
+
+    end_fields = [
+        Field("system_id", ["system_id"]),
+        Field("bike_id", ["bike_id"]),
+        location_field("location", "st_y(location)", "st_x(location)"),
+        Field("arrival_time", ["end_time"])
+    ]
+
+    # Query with only the filters that are set in d_filter, see query_builder.QueryBuilder.
+    def build_query(self, stmt, d_filter):
+        query = QueryBuilder(stmt, self.filter_param_types,
+            start_time=d_filter.get_start_time(), end_time=d_filter.get_end_time())
+        if d_filter.has_zone_filter():
+            query.where(zone_set_filter("location"), zone_ids=d_filter.get_zone_ids())
+        add_operator_filter(query, d_filter)
+        return query
+
+    def get_start_trips(self, conn, d_filter, page=None, projection=None):
         cur = conn.cursor()
+        self.query_start_trips(cur, d_filter, page, projection)
+        rows = cur.fetchall()
+        if page:
+            rows = page.page("start_rentals", rows)
+        if projection:
+            return projection.serialize_rows(rows)
+        return self.serialize_rentals(rows, False)
+
+    def count_start_trips(self, conn, d_filter):
+        return self.count_rentals(conn, self.build_start_trips_query(d_filter))
+
+    def query_start_trips(self, cur, d_filter, page=None, projection=None):
+        query = self.build_start_trips_query(d_filter)
+        query.clause("columns", projection.columns() if projection else all_columns(self.start_fields))
+        # A rental starts when its park event ends, pages follow the end_time the list is filtered on.
+        pagination.apply(query, page, "start_rentals", "end_time", "park_event_id")
+        query.execute(cur)
+
+    def build_start_trips_query(self, d_filter):
         stmt = """ 
-        WITH temp_a (filter_area) AS
-            (
-            SELECT st_union(area) 
-	            FROM zones WHERE zone_id IN %s
-        )
-
-        SELECT system_id, bike_id, st_y(location), st_x(location), start_time
-        FROM park_events, temp_a
+        SELECT {columns}{page_columns}
+        FROM park_events
         WHERE 
-        end_time >= %s
-        AND end_time <= %s
-        AND (false = %s or 
-            (ST_Within(location, temp_a.filter_area)))
-        AND (false = %s or system_id IN %s) 
+        end_time >= %(start_time)s
+        AND end_time <= %(end_time)s
+        AND {filters}
+        {page_order}
         """
-        cur.execute(stmt, (d_filter.get_zones(), d_filter.get_start_time(), 
-            d_filter.get_end_time(), d_filter.has_zone_filter(),
-            d_filter.has_operator_filter(), d_filter.get_operators()))
-        return self.serialize_rentals(cur.fetchall(), False)
+        return self.build_query(stmt, d_filter)
 
-    def get_end_trips(self, conn, d_filter):
+    def get_end_trips(self, conn, d_filter, page=None, projection=None):
         cur = conn.cursor()
+        self.query_end_trips(cur, d_filter, page, projection)
+        rows = cur.fetchall()
+        if page:
+            rows = page.page("end_rentals", rows)
+        if projection:
+            return projection.serialize_rows(rows)
+        return self.serialize_rentals(rows, True)
+
+    def count_end_trips(self, conn, d_filter):
+        return self.count_rentals(conn, self.build_end_trips_query(d_filter))
+
+    def query_end_trips(self, cur, d_filter, page=None, projection=None):
+        query = self.build_end_trips_query(d_filter)
+        query.clause("columns", projection.columns() if projection else all_columns(self.end_fields))
+        pagination.apply(query, page, "end_rentals", "start_time", "park_event_id")
+        query.execute(cur)
+
+    def build_end_trips_query(self, d_filter):
         stmt = """ 
-        WITH temp_a (filter_area) AS
-            (
-            SELECT st_union(area) 
-	            FROM zones WHERE zone_id IN %s
-        )
-
-        SELECT system_id, bike_id, st_y(location), st_x(location), end_time
-        FROM park_events, temp_a
+        SELECT {columns}{page_columns}
+        FROM park_events
         WHERE 
-        start_time >= %s
-        AND start_time <= %s
-        AND (false = %s or 
-            (ST_Within(location, temp_a.filter_area)))
-        AND (false = %s or system_id IN %s) 
+        start_time >= %(start_time)s
+        AND start_time <= %(end_time)s
+        AND {filters}
+        {page_order}
         """
-        cur.execute(stmt, (d_filter.get_zones(), d_filter.get_start_time(), 
-            d_filter.get_end_time(), d_filter.has_zone_filter(),
-            d_filter.has_operator_filter(), d_filter.get_operators()))
-        return self.serialize_rentals(cur.fetchall(), True)
+        return self.build_query(stmt, d_filter)
 
-    def query_stats_start_trip(self, conn, zone_id, d_filter):
+    def count_rentals(self, conn, query):
         cur = conn.cursor()
-        stmt = """WITH temp_a (filter_area) AS
-            (SELECT st_union(area) 
-	            FROM zones WHERE zone_id = %s)
-
-            SELECT SUM(CASE WHEN ST_Within(location, temp_a.filter_area) THEN 1 ELSE 0 END)
-            FROM park_events, temp_a
-            WHERE 
-            end_time >= %s
-            AND end_time <= %s
-            AND (ST_Within(location, temp_a.filter_area))
-            AND (false = %s or system_id IN %s) ;
-        """
-        cur.execute(stmt, (zone_id, 
-            d_filter.get_start_time(), d_filter.get_end_time(),
-            d_filter.has_operator_filter(), d_filter.get_operators()))
-
-        result = cur.fetchone()
-        if (result):
-            return result[0]
-        return 0
-
-    def query_stats_end_trip(self, conn, zone_id, d_filter):
+        query.clause("columns", "COUNT(*)")
+        pagination.apply(query, None, None, None, None)
+        query.execute(cur)
+        return cur.fetchone()[0]
+
+    # Rentals per zone for all zones in the filter in one pass, grouped by zone_id.
+    # The first value counts park events that started (trip ended) in the period, the second
+    # park events that ended (trip started), like the separate per zone queries did before.
+    # Uses the park_event_zone membership table (zone_membership.sql) instead of geometry tests.
+    def get_stats(self, conn, d_filter):
         cur = conn.cursor()
-        stmt = """WITH temp_a (filter_area) AS
-            (SELECT st_union(area) 
-	            FROM zones WHERE zone_id = %s)
-
-            SELECT SUM(CASE WHEN ST_Within(location, temp_a.filter_area) THEN 1 ELSE 0 END)
-            FROM park_events, temp_a
-            WHERE 
-            start_time >= %s
-            AND start_time <= %s
-            AND (ST_Within(location, temp_a.filter_area))
-            AND (false = %s or system_id IN %s) ;
+        stmt = """
+        WITH selected_zones AS (
+            SELECT zone_id, name, owner, municipality, zone_type
+            FROM zones
+            WHERE zone_id = ANY(%(zone_ids)s)
+        ),
+        zone_park_events AS (
+            SELECT park_event_zone.zone_id, start_time, end_time
+            FROM park_event_zone
+            JOIN park_events
+            USING (park_event_id)
+            WHERE park_event_zone.zone_id = ANY(%(zone_ids)s)
+            AND (
+                (start_time >= %(start_time)s AND start_time <= %(end_time)s)
+                OR (end_time >= %(start_time)s AND end_time <= %(end_time)s)
+            )
+            AND {filters}
+        )
+        SELECT selected_zones.zone_id, name, owner, municipality, zone_type,
+            SUM(CASE WHEN start_time >= %(start_time)s AND start_time <= %(end_time)s THEN 1 END),
+            SUM(CASE WHEN end_time >= %(start_time)s AND end_time <= %(end_time)s THEN 1 END)
+        FROM selected_zones
+        LEFT JOIN zone_park_events
+        USING (zone_id)
+        GROUP BY selected_zones.zone_id, name, owner, municipality, zone_type;
         """
-        cur.execute(stmt, (zone_id, 
-            d_filter.get_start_time(), d_filter.get_end_time(),
-            d_filter.has_operator_filter(), d_filter.get_operators()))
-
-        result = cur.fetchone()
-        if (result):
-            return result[0]
-        return 0
-
-    def query_stats(self, conn, zone_id, d_filter):
-        result = {}
-        values = [self.query_stats_end_trip(conn, zone_id, d_filter), self.query_stats_start_trip(conn, zone_id, d_filter)]
-        result["zone_id"] = zone_id
-        result["number_of_trips"] = values
-        result["zone"] = self.zones.get_zone(conn, zone_id)
-        return result
-    
-    def get_stats(self, conn, d_filter):
+        query = QueryBuilder(stmt, self.filter_param_types, start_time=d_filter.get_start_time(),
+            end_time=d_filter.get_end_time(), zone_ids=d_filter.get_zone_ids())
+        add_operator_filter(query, d_filter)
+        query.execute(cur)
+        stats_per_zone = {}
+        for row in cur.fetchall():
+            stats_per_zone[row[0]] = row
+
         records = []
         for zone_id in d_filter.get_zones():
-            result = self.query_stats(conn, zone_id, d_filter)
+            row = stats_per_zone.get(int(zone_id))
+            result = {}
+            result["zone_id"] = zone_id
+            if row:
+                result["number_of_trips"] = [row[5], row[6]]
+                result["zone"] = self.zones.serialize_zone(row[:5])
+            else:
+                result["number_of_trips"] = [None, None]
+                result["zone"] = None
             records.append(result)
         return records
 
@@ -0,0 +1,107 @@
+import gzip
+import hashlib
+import json
+import os
+import time
+from datetime import datetime, timedelta, timezone
+from functools import wraps
+from flask import request, make_response
+import redis
+import data_filter
+from redis_helper import redis_helper
+
+# Interval in seconds at which the importer refreshes the vehicle feeds.
+feed_import_interval = int(os.getenv("FEED_IMPORT_INTERVAL", 60))
+
+# TTL that lets entries expire right after the next feed import, so all cached responses
+# based on live vehicle data are refreshed at the same moment.
+def until_next_feed_import(d_filter):
+    return feed_import_interval - int(time.time()) % feed_import_interval
+
+# Data older than 36 hours doesn't change anymore, newer data changes with every feed import.
+def until_next_feed_import_or_historic(d_filter):
+    timestamp = d_filter.get_timestamp()
+    if timestamp is not None and timestamp < datetime.now(timezone.utc) - timedelta(hours=36):
+        return 24 * 3600
+    return until_next_feed_import(d_filter)
+
+def static_ttl(seconds):
+    return lambda d_filter: seconds
+
+# Cache for responses of public endpoints, stored gzip compressed in Redis.
+#
+# The key is built from the route, the canonical DataFilter and the other query
+# parameters the endpoint uses, so equal requests share one entry.
+class ResponseCache():
+    def __init__(self, prefix="response_cache"):
+        self.prefix = prefix
+
+    def get_key(self, route, d_filter, args):
+        data = {}
+        data["filter"] = d_filter.to_canonical_dict()
+        data["args"] = {arg: request.args.get(arg) for arg in args}
+        digest = hashlib.sha1(json.dumps(data, sort_keys=True).encode()).hexdigest()
+        return "%s:%s:%s" % (self.prefix, route, digest)
+
+    # Decorator for a view, ttl is a function that gets the DataFilter and returns seconds,
+    # args lists the query parameters besides the filter that change the response.
+    def cached(self, route, ttl, args=(), ignore_timestamp=False):
+        def decorator(f):
+            @wraps(f)
+            def decorated(*view_args, **view_kwargs):
+                d_filter = data_filter.DataFilter.build(request.args)
+                if ignore_timestamp:
+                    d_filter.timestamp = None
+                key = self.get_key(route, d_filter, args)
+
+                body = self.load(key)
+                if body is not None:
+                    return self.build_response(body, "HIT")
+
+                response = make_response(f(*view_args, **view_kwargs))
+                if response.status_code == 200 and not response.is_streamed:
+                    self.store(key, gzip.compress(response.get_data(), 6), ttl(d_filter))
+                    response.headers["X-Cache"] = "MISS"
+                return response
+            return decorated
+        return decorator
+
+    def build_response(self, body, status):
+        if "gzip" in request.headers.get("Accept-Encoding", ""):
+            response = make_response(body)
+            response.headers["Content-Encoding"] = "gzip"
+        else:
+            response = make_response(gzip.decompress(body))
+        response.mimetype = "application/json"
+        response.headers["Vary"] = "Accept-Encoding"
+        response.headers["X-Cache"] = status
+        return response
+
+    def load(self, key):
+        try:
+            with redis_helper.get_resource() as r:
+                return r.get(key)
+        except redis.exceptions.RedisError as e:
+            print("Response cache unavailable: %s" % e)
+            return None
+
+    def store(self, key, body, ttl):
+        try:
+            with redis_helper.get_resource() as r:
+                r.set(key, body, ex=max(int(ttl), 1))
+        except redis.exceptions.RedisError as e:
+            print("Response cache unavailable: %s" % e)
+
+    # Removes all cached responses of a route, or of all routes when route is None.
+    def invalidate(self, route=None):
+        pattern = "%s:%s:*" % (self.prefix, route or "*")
+        try:
+            with redis_helper.get_resource() as r:
+                keys = list(r.scan_iter(match=pattern, count=1000))
+                if keys:
+                    r.delete(*keys)
+        except redis.exceptions.RedisError as e:
+            print("Response cache invalidation failed: %s" % e)
+
+
+response_cache = ResponseCache()
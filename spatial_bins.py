@@ -0,0 +1,142 @@
+import math
+import os
+
+# Width of the web mercator (EPSG:3857) world in meters, the width of the tile at zoom 0.
+world_size = 40075016.686
+max_zoom = 22
+# Width of a cluster in pixels of a 256 pixel tile, so a map view has about the same number
+# of clusters at every zoom level.
+cluster_pixels = int(os.getenv("CLUSTER_PIXELS", 64))
+
+grid_functions = {
+    "square": "ST_SquareGrid",
+    "hex": "ST_HexagonGrid"
+}
+
+# Bin sizes for heatmaps with bins=square|hex&resolution=<size>.
+default_resolution = 500
+min_resolution = 50
+max_resolution = 10000
+# Most bins a heatmap may cover, a bbox with more bins of the requested resolution gets bigger bins.
+max_bins = int(os.getenv("HEATMAP_MAX_BINS", 10000))
+# Without a bbox the heatmap covers all data of the filter, smaller bins need a bbox.
+min_resolution_without_bbox = int(os.getenv("HEATMAP_MIN_RESOLUTION_WITHOUT_BBOX", 2000))
+# Web mercator is only defined up to this latitude.
+max_latitude = 85.0511
+
+param_types = [("bin_size", "float8")]
+
+class InvalidBins(Exception):
+    pass
+
+# Square or hexagonal bins of `size` web mercator meters, to aggregate points in PostGIS.
+#
+# ST_SquareGrid and ST_HexagonGrid called with a point as bounds return the cell that contains
+# the point, so a row is put in its bin without generating the grid over the whole area.
+# The cell is identified by (i, j), its centroid is returned as the location of the bin.
+class SpatialBins():
+    def __init__(self, shape, size):
+        self.shape = shape
+        self.size = size
+
+    # LATERAL join that adds bin_i, bin_j, bin_latitude and bin_longitude for point `column` (EPSG:4326),
+    # the statement should pass %(bin_size)s.
+    def join(self, column):
+        return """CROSS JOIN LATERAL (
+            SELECT i AS bin_i, j AS bin_j,
+                ST_Y(ST_Transform(ST_Centroid(geom), 4326)) AS bin_latitude,
+                ST_X(ST_Transform(ST_Centroid(geom), 4326)) AS bin_longitude
+            FROM """ + grid_functions[self.shape] + """(%(bin_size)s, ST_Transform(""" + column + """, 3857))
+            LIMIT 1
+        ) AS bin"""
+
+    # Area of one bin in web mercator square meters, `size` is the side of a square or hexagon.
+    def bin_area(self):
+        if self.shape == "hex":
+            return 3 * math.sqrt(3) / 2 * self.size ** 2
+        return self.size ** 2
+
+    # Enlarges the bins so bbox [sw_lng, sw_lat, ne_lng, ne_lat] is covered by at most max_bins bins.
+    def fit(self, bbox):
+        bin_count = mercator_area(bbox) / self.bin_area()
+        if bin_count > max_bins:
+            self.size = math.ceil(self.size * math.sqrt(bin_count / max_bins))
+
+    def serialize(self):
+        data = {}
+        data["shape"] = self.shape
+        data["size"] = self.size
+        return data
+
+# Bins of about cluster_pixels wide on the map at this zoom level.
+def for_zoom(shape, zoom):
+    return SpatialBins(shape, world_size / 2 ** zoom * cluster_pixels / 256)
+
+def is_cluster_requested(args):
+    return args.get("cluster") is not None
+
+def get_shape(value):
+    if value not in grid_functions:
+        raise InvalidBins("Invalid shape '%s', value should be one of: %s" % (value, ", ".join(grid_functions)))
+    return value
+
+# Bins for cluster=square|hex&zoom=<zoom level>, raises InvalidBins when they are invalid.
+def from_zoom_args(args):
+    shape = get_shape(args.get("cluster"))
+    zoom = args.get("zoom", "")
+    if not zoom.isdigit() or int(zoom) > max_zoom:
+        raise InvalidBins("Invalid zoom, value should be an integer between 0 and %s" % max_zoom)
+    return for_zoom(shape, int(zoom))
+
+def mercator_y(latitude):
+    latitude = max(min(latitude, max_latitude), -max_latitude)
+    return world_size / (2 * math.pi) * math.log(math.tan(math.pi / 4 + math.radians(latitude) / 2))
+
+# Area of bbox [sw_lng, sw_lat, ne_lng, ne_lat] in web mercator square meters.
+def mercator_area(bbox):
+    width = (bbox[2] - bbox[0]) / 360 * world_size
+    return width * (mercator_y(bbox[3]) - mercator_y(bbox[1]))
+
+# Bins for bins=square|hex&resolution=<size in web mercator meters>, hexagons of 500 by default.
+# With a bbox the bins are enlarged to at most max_bins for the bbox (serialize() has the size
+# that is used), without one the resolution should be at least min_resolution_without_bbox.
+def from_resolution_args(args, bbox=None):
+    shape = get_shape(args.get("bins", "hex"))
+    resolution = args.get("resolution", str(default_resolution))
+    if not resolution.isdigit() or int(resolution) < min_resolution or int(resolution) > max_resolution:
+        raise InvalidBins("Invalid resolution, value should be an integer between %s and %s" %
+            (min_resolution, max_resolution))
+    if bbox is None and int(resolution) < min_resolution_without_bbox:
+        raise InvalidBins("A bbox is required for a resolution below %s" % min_resolution_without_bbox)
+    bins = SpatialBins(shape, int(resolution))
+    if bbox is not None:
+        bins.fit(bbox)
+    return bins
+
+def group_key(value):
+    if value is None:
+        return "unknown"
+    return str(value)
+
+# Rows are (bin_i, bin_j, bin_latitude, bin_longitude, <value per group>..., count), one bin
+# can have several rows. Returns a list with per bin its location, total count and per group
+# (e.g. operators, form_factors) the count per value.
+def serialize_bins(rows, groups):
+    bins = {}
+    for row in rows:
+        key = (row[0], row[1])
+        if key not in bins:
+            data = {}
+            data["location"] = {}
+            data["location"]["latitude"] = row[2]
+            data["location"]["longitude"] = row[3]
+            data["count"] = 0
+            for group in groups:
+                data[group] = {}
+            bins[key] = data
+        count = row[-1]
+        bins[key]["count"] += count
+        for index, group in enumerate(groups):
+            value = group_key(row[4 + index])
+            bins[key][group][value] = bins[key][group].get(value, 0) + count
+    return list(bins.values())
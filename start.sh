@@ -1,2 +1,6 @@
 #!/usr/bin/env bash
-uwsgi --ini uwsgi.ini
+if [ "$ASYNC_MODE" = "gevent" ]; then
+    uwsgi --ini uwsgi_async.ini
+else
+    uwsgi --ini uwsgi.ini
+fi
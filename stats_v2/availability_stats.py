@@ -1,4 +1,5 @@
 from psycopg2 import sql
+from query_builder import QueryBuilder
 
 class AvailabilityStats():
     def converted_aggregation_level(self, aggregation_level):
@@ -12,13 +13,19 @@ class AvailabilityStats():
         }
         return allowed_aggregation_levels[aggregation_level];
 
-    def get_params(self, d_filter, agg_level):
-        return {
-            "agg_level": agg_level,
-            "zone_ids": d_filter.get_zones(),
-            "start_time": d_filter.get_start_time(),
-            "end_time": d_filter.get_end_time()
-        }
+    param_types = [
+        ("agg_level", "interval"),
+        ("zone_ids", "integer[]"),
+        ("start_time", "timestamptz"),
+        ("end_time", "timestamptz")
+    ]
+
+    # Query for the zones of d_filter, see query_builder.QueryBuilder.
+    def build_query(self, template, d_filter, agg_level):
+        query = QueryBuilder(template, self.param_types, agg_level=agg_level,
+            start_time=d_filter.get_start_time(), end_time=d_filter.get_end_time())
+        query.where("zone_id = ANY({zone_ids})", zone_ids=d_filter.get_zone_ids())
+        return query
 
     def get_availability_stats(self, conn, d_filter, aggregation_level, group_by, aggregation_function):
         if group_by == 'modality':
@@ -33,21 +40,18 @@ class AvailabilityStats():
             SELECT
                 modality,
                 time_bucket_gapfill(%(agg_level)s, time) AS bucket,
-                {}(number_of_vehicles_parked) as amount
+                """ + aggregation_function + """(number_of_vehicles_parked) as amount
             FROM stats_number_of_vehicles_parked
             WHERE
                 time >= (%(start_time)s) 
                 AND time <= (%(end_time)s)
-                AND zone_id IN (%(zone_ids)s)
+                AND {filters}
             GROUP BY bucket, modality
             ORDER BY bucket ASC, modality
         """
-        sql_query = query.format(aggregation_function)
-
-        params = self.get_params(d_filter, aggregation_level)
-
         cur = conn.cursor()
-        cur.execute(sql_query, params)
+        # Not prepared, time_bucket_gapfill can't infer its range from the parameters of a generic plan.
+        self.build_query(query, d_filter, agg_level).execute(cur, prepare=False)
         rows = cur.fetchall()
         conn.commit()
 
@@ -64,21 +68,17 @@ class AvailabilityStats():
                 system_id,
                 modality,
                 time_bucket(%(agg_level)s, time) AS bucket,
-                {}(number_of_vehicles_parked) as amount
+                """ + aggregation_function + """(number_of_vehicles_parked) as amount
             FROM stats_number_of_vehicles_parked
             WHERE
                 time >= (%(start_time)s) 
                 AND time <= (%(end_time)s)
-                AND zone_id IN %(zone_ids)s
+                AND {filters}
             GROUP BY bucket, system_id, modality
             ORDER BY bucket ASC, system_id
         """
-        sql_query = query.format(aggregation_function)
-
-        params = self.get_params(d_filter, agg_level)
-
         cur = conn.cursor()
-        cur.execute(sql_query, params)
+        self.build_query(query, d_filter, agg_level).execute(cur)
         rows = cur.fetchall()
         conn.commit()
 
@@ -1,4 +1,5 @@
 from psycopg2 import sql
+from query_builder import QueryBuilder
 
 class RentalStats():
     def converted_aggregation_level(self, aggregation_level):
@@ -12,13 +13,19 @@ class RentalStats():
         }
         return allowed_aggregation_levels[aggregation_level];
 
-    def get_params(self, d_filter, agg_level):
-        return {
-            "agg_level": agg_level,
-            "zone_ids": d_filter.get_zones(),
-            "start_time": d_filter.get_start_time(),
-            "end_time": d_filter.get_end_time()
-        }
+    param_types = [
+        ("agg_level", "interval"),
+        ("zone_ids", "integer[]"),
+        ("start_time", "timestamptz"),
+        ("end_time", "timestamptz")
+    ]
+
+    # Query for the zones of d_filter, see query_builder.QueryBuilder.
+    def build_query(self, template, d_filter, agg_level):
+        query = QueryBuilder(template, self.param_types, agg_level=agg_level,
+            start_time=d_filter.get_start_time(), end_time=d_filter.get_end_time())
+        query.where("zone_id = ANY({zone_ids})", zone_ids=d_filter.get_zone_ids())
+        return query
 
     def get_rental_stats(self, conn, d_filter, aggregation_level):
         agg_level = self.converted_aggregation_level(aggregation_level)
@@ -34,15 +41,14 @@ class RentalStats():
             WHERE
                 time >= (%(start_time)s) 
                 AND time <= (%(end_time)s)
-                AND zone_id IN %(zone_ids)s
+                AND {filters}
             GROUP BY bucket, system_id, modality
             ORDER BY bucket ASC, system_id
         """
 
-        params = self.get_params(d_filter, agg_level)
-
         cur = conn.cursor()
-        cur.execute(query, params)
+        # Not prepared, time_bucket_gapfill can't infer its range from the parameters of a generic plan.
+        self.build_query(query, d_filter, agg_level).execute(cur, prepare=False)
         rows = cur.fetchall()
         conn.commit()
 
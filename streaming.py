@@ -0,0 +1,53 @@
+import psycopg2
+import psycopg2.errors
+from flask import Response, stream_with_context, json, g
+from query_budget import stream_budget_ms
+
+# Streams a JSON object with one array per (key, cursor, serialize) part.
+#
+# The cursors should be named (server side) cursors, rows are fetched in chunks of `chunk_size`
+# and written to the response as soon as they are serialized, so a large result is never held
+# in memory as a whole. When streaming starts the request's query budget is replaced by the
+# stream budget (QUERY_BUDGET_STREAM_MS). Errors after the first chunk can't change the status
+# code anymore, the open array is closed and the document ends with an "error" object instead.
+def stream_json(parts, chunk_size=2000):
+    def generate():
+        if g.get("query_budget") is not None:
+            g.query_budget.restart("stream", stream_budget_ms)
+        yield "{"
+        for index, (key, cur, serialize) in enumerate(parts):
+            if index > 0:
+                yield ","
+            yield json.dumps(key) + ":["
+            first = True
+            while True:
+                try:
+                    rows = cur.fetchmany(chunk_size)
+                except psycopg2.Error as e:
+                    yield "]," + json.dumps("error") + ":" + json.dumps(stream_error(e)) + "}"
+                    return
+                if not rows:
+                    break
+                if not first:
+                    yield ","
+                yield ",".join(json.dumps(serialize(row)) for row in rows)
+                first = False
+            yield "]"
+            cur.close()
+        yield "}"
+
+    return Response(stream_with_context(generate()), mimetype="application/json")
+
+def stream_error(e):
+    data = {}
+    if isinstance(e, psycopg2.errors.QueryCanceled):
+        data["code"] = 504
+        data["message"] = "Query time budget exceeded, the result is incomplete."
+    else:
+        data["code"] = 500
+        data["message"] = "Query failed, the result is incomplete."
+    print("Streaming failed: %s" % e)
+    return data
+
+def is_requested(args):
+    return args.get("stream") == "true"
@@ -0,0 +1,61 @@
+import base64
+import binascii
+import json
+import os
+from datetime import datetime, timedelta, timezone
+import pagination
+
+# Park events are imported some time after they start or end, so every sync also looks back
+# this many seconds before the previous sync. Clients upsert added and delete removed park
+# events by park_event_id, so events that are returned twice don't matter.
+sync_overlap = int(os.getenv("SYNC_OVERLAP", 180))
+
+param_types = [
+    ("since", "timestamptz"),
+    ("until", "timestamptz")
+]
+
+class InvalidSyncToken(Exception):
+    pass
+
+# Incremental sync of the vehicles that are parked right now.
+#
+# The first request (sync=true) returns all parked vehicles, every next request passes the
+# sync_token of the previous response as since=<token> and gets only the park events that
+# started (added) or ended (removed) in between. The token is opaque for the client and is
+# bound to the endpoint and filter it was created for, like the cursors of pagination.py.
+class Sync():
+    def __init__(self, fingerprint, since=None):
+        self.fingerprint = fingerprint
+        self.since = since
+        self.until = datetime.now(timezone.utc)
+
+    def is_initial(self):
+        return self.since is None
+
+    # Start of the changes that are returned, including the overlap for late imports.
+    def get_changes_since(self):
+        return self.since - timedelta(seconds=sync_overlap)
+
+    def next_token(self):
+        data = {"f": self.fingerprint, "t": self.until.isoformat()}
+        return base64.urlsafe_b64encode(json.dumps(data).encode()).decode()
+
+def is_requested(args):
+    return args.get("sync") == "true" or args.get("since") is not None
+
+# Sync for this request, raises InvalidSyncToken when the since token is invalid.
+# The filter shouldn't have a timestamp, a sync is always about the current moment.
+def from_args(args, endpoint, d_filter):
+    fingerprint = pagination.get_fingerprint(endpoint, d_filter)
+    if not args.get("since"):
+        return Sync(fingerprint)
+    try:
+        data = json.loads(base64.urlsafe_b64decode(args.get("since").encode()))
+        token_fingerprint = data["f"]
+        since = datetime.fromisoformat(data["t"])
+    except (binascii.Error, ValueError, KeyError, TypeError):
+        raise InvalidSyncToken("Invalid since token")
+    if token_fingerprint != fingerprint:
+        raise InvalidSyncToken("Token doesn't belong to this endpoint and filter")
+    return Sync(fingerprint, since)
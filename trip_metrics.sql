@@ -0,0 +1,59 @@
+-- Distance and duration per trip, computed once when the trip is stored instead of in every
+-- query that lists or aggregates trips. Kept up to date by the trigger below.
+-- distance_in_meters is the same approximation the trip endpoints used to compute per row:
+-- the web mercator distance corrected with the cosine of the start latitude.
+-- Existing trips are filled at the end of this file, after the trigger is in place.
+
+CREATE TABLE IF NOT EXISTS trip_metrics (
+    trip_id bigint PRIMARY KEY,
+    distance_in_meters integer,
+    duration_in_seconds integer
+);
+
+CREATE OR REPLACE FUNCTION trip_distance_in_meters(start_location geometry, end_location geometry) RETURNS integer AS $$
+    SELECT ROUND(
+        ST_Distance(
+            ST_Transform(start_location, 3857),
+            ST_Transform(end_location, 3857)
+        ) * cosd(ST_Y(start_location))
+    )::integer;
+$$ LANGUAGE sql IMMUTABLE;
+
+CREATE OR REPLACE FUNCTION trip_metrics_update() RETURNS trigger AS $$
+BEGIN
+    INSERT INTO trip_metrics (trip_id, distance_in_meters, duration_in_seconds)
+    VALUES (
+        NEW.trip_id,
+        trip_distance_in_meters(NEW.start_location::geometry, NEW.end_location::geometry),
+        EXTRACT(EPOCH FROM NEW.end_time - NEW.start_time)::integer
+    )
+    ON CONFLICT (trip_id) DO UPDATE
+    SET distance_in_meters = EXCLUDED.distance_in_meters,
+        duration_in_seconds = EXCLUDED.duration_in_seconds;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS trip_metrics_trigger ON trips;
+CREATE TRIGGER trip_metrics_trigger
+    AFTER INSERT OR UPDATE OF start_location, end_location, start_time, end_time ON trips
+    FOR EACH ROW EXECUTE FUNCTION trip_metrics_update();
+
+CREATE OR REPLACE FUNCTION trip_metrics_delete() RETURNS trigger AS $$
+BEGIN
+    DELETE FROM trip_metrics WHERE trip_id = OLD.trip_id;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS trip_metrics_delete_trigger ON trips;
+CREATE TRIGGER trip_metrics_delete_trigger
+    AFTER DELETE ON trips
+    FOR EACH ROW EXECUTE FUNCTION trip_metrics_delete();
+
+-- Initial fill for the trips stored before the trigger existed, running it again is a no-op.
+INSERT INTO trip_metrics (trip_id, distance_in_meters, duration_in_seconds)
+SELECT trip_id, trip_distance_in_meters(start_location::geometry, end_location::geometry),
+    EXTRACT(EPOCH FROM end_time - start_time)::integer
+FROM trips
+ON CONFLICT (trip_id) DO NOTHING;
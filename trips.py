@@ -2,86 +2,146 @@ import json
 from bson import json_util
 import psycopg2.extras
 import zones
+import pagination
+from projection import Field, location_field, all_columns
+from query_builder import QueryBuilder, add_operator_filter, add_form_factor_filter
 
 class Trips():
     def __init__(self):
         self.zones = zones.Zones()
 
-    def get_trips(self, conn, d_filter):
+    filter_param_types = [
+        ("start_time", "timestamptz"),
+        ("end_time", "timestamptz"),
+        ("zone_ids", "integer[]"),
+        ("system_ids", "text[]"),
+        ("form_factors", "text[]")
+    ]
+
+    # Fields of a trip, in the order of serialize_trip.
+    fields = [
+        Field("system_id", ["trips.system_id"]),
+        Field("bike_id", ["bike_id"]),
+        location_field("start_location", "st_y(start_location)", "st_x(start_location)"),
+        location_field("end_location", "st_y(end_location)", "st_x(end_location)"),
+        Field("start_time", ["start_time"]),
+        Field("end_time", ["end_time"]),
+        Field("trip_id", ["trips.trip_id"]),
+        Field("form_factor", ["form_factor"]),
+        Field("distance_in_meters", ["trip_metrics.distance_in_meters"])
+    ]
+
+    # Query with only the filters that are set in d_filter, see query_builder.QueryBuilder.
+    def build_query(self, stmt, d_filter):
+        query = QueryBuilder(stmt, self.filter_param_types,
+            start_time=d_filter.get_start_time(), end_time=d_filter.get_end_time())
+        if d_filter.has_zone_filter():
+            query.where("""trips.trip_id IN (
+                SELECT trip_id
+                FROM trip_zone
+                WHERE zone_id = ANY({zone_ids})
+            )""", zone_ids=d_filter.get_zone_ids())
+        add_operator_filter(query, d_filter, "trips.system_id")
+        add_form_factor_filter(query, d_filter)
+        return query
+
+    # page is a pagination.Pagination when the client pages through the trips,
+    # projection a projection.Projection when the client only wants some of the fields.
+    def get_trips(self, conn, d_filter, page=None, projection=None):
         cur = conn.cursor()
-        stmt = """ 
-        WITH temp_a (filter_area) AS
-            (
-            SELECT st_union(area) 
-	            FROM zones WHERE zone_id IN %s
-        )
+        self.query_trips(cur, d_filter, page, projection)
+        rows = cur.fetchall()
+        if page:
+            rows = page.page("trips", rows)
+        if projection:
+            return projection.serialize_rows(rows)
+        return self.serialize_trips(rows)
 
-        SELECT trips.system_id, bike_id, st_y(start_location), st_x(start_location), 
-        st_y(end_location), st_x(end_location), start_time, end_time, trip_id, form_factor,
-        ROUND(    
-            ST_Distance(
-			    ST_Transform(start_location::geometry, 3857),
-			    ST_Transform(end_location::geometry, 3857)
-		    ) * cosd(ST_Y(start_location)
-        )) as distance_in_meters
-        FROM trips CROSS JOIN temp_a
+    def count_trips(self, conn, d_filter):
+        cur = conn.cursor()
+        query = self.build_trips_query(d_filter)
+        query.clause("columns", "COUNT(*)")
+        pagination.apply(query, None, None, None, None)
+        query.execute(cur)
+        return cur.fetchone()[0]
+
+    def query_trips(self, cur, d_filter, page=None, projection=None):
+        query = self.build_trips_query(d_filter)
+        query.clause("columns", projection.columns() if projection else all_columns(self.fields))
+        pagination.apply(query, page, "trips", "start_time", "trips.trip_id")
+        query.execute(cur)
+
+    # The joins with vehicle_type and trip_metrics (trip_metrics.sql) are removed by the planner
+    # when none of their columns are selected or filtered on.
+    def build_trips_query(self, d_filter):
+        stmt = """ 
+        SELECT {columns}{page_columns}
+        FROM trips
         LEFT JOIN vehicle_type
         ON trips.vehicle_type_id = vehicle_type.vehicle_type_id
+        LEFT JOIN trip_metrics
+        ON trips.trip_id = trip_metrics.trip_id
         WHERE 
-        start_time >= %s
-        AND end_time <= %s
-        AND (false = %s or 
-            (ST_Within(start_location, temp_a.filter_area) OR
-             ST_Within(end_location, temp_a.filter_area) ))
-        AND (false = %s or trips.system_id IN %s)
-        AND (false = %s or 
-                (form_factor in %s or (true = %s and form_factor is null))
-            ) 
+        start_time >= %(start_time)s
+        AND end_time <= %(end_time)s
+        AND {filters}
+        {page_order}
         """
-        cur.execute(stmt, (d_filter.get_zones(), d_filter.get_start_time(), 
-            d_filter.get_end_time(), d_filter.has_zone_filter(),
-            d_filter.has_operator_filter(), d_filter.get_operators(),
-            d_filter.has_form_factor_filter(), d_filter.get_form_factors(),
-            d_filter.include_unknown_form_factors()))
-        return self.serialize_trips(cur.fetchall())
-
-    def query_stats(self, conn, zone_id, d_filter):
-        cur = conn.cursor()
-        stmt = """WITH temp_a (filter_area) AS
-            (SELECT st_union(area) 
-	            FROM zones WHERE zone_id = %s)
-
-            SELECT SUM(CASE WHEN ST_Within(start_location, temp_a.filter_area) THEN 1 ELSE 0 END), 
-                SUM(CASE WHEN ST_Within(end_location, temp_a.filter_area) THEN 1 ELSE 0 END)
-            FROM trips, temp_a
-            WHERE 
-            start_time >= %s
-            AND end_time <= %s
-            AND ((ST_Within(start_location, temp_a.filter_area) OR
-                ST_Within(end_location, temp_a.filter_area) ))
-            AND (false = %s or system_id IN %s) ;
-        """
-        cur.execute(stmt, (zone_id, 
-            d_filter.get_start_time(), d_filter.get_end_time(),
-            d_filter.has_operator_filter(), d_filter.get_operators()))
-
-        result = {}
-        result["zone_id"] = zone_id
-        result["number_of_trips"] = self.get_stat_values(cur.fetchone())
-        result["zone"] = self.zones.get_zone(conn, zone_id)
-        return result
+        return self.build_query(stmt, d_filter)
 
     def get_stat_values(self, data):
         if not data[0]:
             return [0, 0]
         else:
             return data
-        
-    
+
+    # Trips starting and ending in every zone of the filter in one pass, grouped by zone_id.
+    # Uses the trip_zone membership table (zone_membership.sql) instead of geometry tests.
     def get_stats(self, conn, d_filter):
+        cur = conn.cursor()
+        stmt = """
+        WITH selected_zones AS (
+            SELECT zone_id, name, owner, municipality, zone_type
+            FROM zones
+            WHERE zone_id = ANY(%(zone_ids)s)
+        ),
+        zone_trips AS (
+            SELECT trip_zone.zone_id, starts_in, ends_in
+            FROM trip_zone
+            JOIN trips
+            USING (trip_id)
+            WHERE trip_zone.zone_id = ANY(%(zone_ids)s)
+            AND start_time >= %(start_time)s
+            AND end_time <= %(end_time)s
+            AND {filters}
+        )
+        SELECT selected_zones.zone_id, name, owner, municipality, zone_type,
+            SUM(CASE WHEN starts_in THEN 1 ELSE 0 END), 
+            SUM(CASE WHEN ends_in THEN 1 ELSE 0 END)
+        FROM selected_zones
+        LEFT JOIN zone_trips
+        USING (zone_id)
+        GROUP BY selected_zones.zone_id, name, owner, municipality, zone_type;
+        """
+        query = QueryBuilder(stmt, self.filter_param_types, start_time=d_filter.get_start_time(),
+            end_time=d_filter.get_end_time(), zone_ids=d_filter.get_zone_ids())
+        add_operator_filter(query, d_filter)
+        query.execute(cur)
+        stats_per_zone = {}
+        for row in cur.fetchall():
+            stats_per_zone[row[0]] = row
+
         records = []
         for zone_id in d_filter.get_zones():
-            result = self.query_stats(conn, zone_id, d_filter)
+            row = stats_per_zone.get(int(zone_id))
+            result = {}
+            result["zone_id"] = zone_id
+            if row:
+                result["number_of_trips"] = self.get_stat_values(row[5:7])
+                result["zone"] = self.zones.serialize_zone(row[:5])
+            else:
+                result["number_of_trips"] = [0, 0]
+                result["zone"] = None
             records.append(result)
         return records
 
@@ -2,81 +2,282 @@ import json
 from bson import json_util
 import psycopg2.extras
 import zones
+import pagination
+import spatial_bins
+from projection import Field, location_field, all_columns
+from query_builder import QueryBuilder, add_operator_filter, add_form_factor_filter
 
 class Trips():
-    def get_trip_origins(self, conn, d_filter):
+    filter_param_types = [
+        ("start_time", "timestamptz"),
+        ("end_time", "timestamptz"),
+        ("zone_ids", "integer[]"),
+        ("system_ids", "text[]"),
+        ("form_factors", "text[]"),
+        ("sw_lng", "float8"),
+        ("sw_lat", "float8"),
+        ("ne_lng", "float8"),
+        ("ne_lat", "float8")
+    ]
+
+    # Lower bounds of the bins of the trip histograms, in meters and seconds.
+    distance_bins = [0, 250, 500, 1000, 1500, 2000, 3000, 5000, 10000]
+    duration_bins = [0, 120, 300, 600, 900, 1200, 1800, 3600, 7200]
+
+    # Upper bounds in meters of the distance classes of the heatmaps, the last class is open ended.
+    distance_classes = [500, 1000, 2000, 5000]
+
+    # Fields of a trip origin and a trip destination, in the order of serialize_trip_event.
+    origin_fields = [
+        Field("system_id", ["trips.system_id"]),
+        location_field("location", "st_y(start_location)", "st_x(start_location)"),
+        Field("event_time", ["start_time"]),
+        Field("form_factor", ["form_factor"]),
+        Field("distance_in_meters", ["(trip_metrics.distance_in_meters + 50) / 100 * 100"])
+    ]
+
+    destination_fields = [
+        Field("system_id", ["trips.system_id"]),
+        location_field("location", "st_y(end_location)", "st_x(end_location)"),
+        Field("event_time", ["end_time"]),
+        Field("form_factor", ["form_factor"]),
+        Field("distance_in_meters", ["(trip_metrics.distance_in_meters + 50) / 100 * 100"])
+    ]
+
+    # Query with only the filters that are set in d_filter, see query_builder.QueryBuilder.
+    # membership is the trip_zone column that should be true: starts_in or ends_in.
+    def build_query(self, stmt, d_filter, membership):
+        query = QueryBuilder(stmt, self.filter_param_types,
+            start_time=d_filter.get_start_time(), end_time=d_filter.get_end_time())
+        if d_filter.has_zone_filter():
+            query.where("""trips.trip_id IN (
+                SELECT trip_id
+                FROM trip_zone
+                WHERE zone_id = ANY({zone_ids})
+                AND """ + membership + """
+            )""", zone_ids=d_filter.get_zone_ids())
+        add_operator_filter(query, d_filter, "trips.system_id")
+        add_form_factor_filter(query, d_filter)
+        return query
+
+    def get_trip_origins(self, conn, d_filter, page=None, projection=None):
+        cur = conn.cursor()
+        self.query_trip_origins(cur, d_filter, page, projection)
+        rows = cur.fetchall()
+        if page:
+            rows = page.page("trip_origins", rows)
+        if projection:
+            return projection.serialize_rows(rows)
+        return self.serialize_trip_events(rows)
+
+    def count_trip_origins(self, conn, d_filter):
+        return self.count_trip_events(conn, d_filter, "starts_in")
+
+    def query_trip_origins(self, cur, d_filter, page=None, projection=None):
+        query = self.build_trip_events_query(d_filter, "starts_in")
+        query.clause("columns", projection.columns() if projection else all_columns(self.origin_fields))
+        pagination.apply(query, page, "trip_origins", "start_time", "trips.trip_id")
+        query.execute(cur)
+
+    def get_trip_destinations(self, conn, d_filter, page=None, projection=None):
         cur = conn.cursor()
+        self.query_trip_destinations(cur, d_filter, page, projection)
+        rows = cur.fetchall()
+        if page:
+            rows = page.page("trip_destinations", rows)
+        if projection:
+            return projection.serialize_rows(rows)
+        return self.serialize_trip_events(rows)
+
+    def count_trip_destinations(self, conn, d_filter):
+        return self.count_trip_events(conn, d_filter, "ends_in")
+
+    def query_trip_destinations(self, cur, d_filter, page=None, projection=None):
+        query = self.build_trip_events_query(d_filter, "ends_in")
+        query.clause("columns", projection.columns() if projection else all_columns(self.destination_fields))
+        pagination.apply(query, page, "trip_destinations", "start_time", "trips.trip_id")
+        query.execute(cur)
+
+    def count_trip_events(self, conn, d_filter, membership):
+        cur = conn.cursor()
+        query = self.build_trip_events_query(d_filter, membership)
+        query.clause("columns", "COUNT(*)")
+        pagination.apply(query, None, None, None, None)
+        query.execute(cur)
+        return cur.fetchone()[0]
+
+    def build_trip_events_query(self, d_filter, membership):
         stmt = """ 
-        WITH temp_a (filter_area) AS
-            (
-            SELECT st_union(area) 
-	            FROM zones WHERE zone_id IN %s
-        )
-
-        SELECT trips.system_id, st_y(start_location), st_x(start_location),
-        start_time, form_factor,
-        ROUND(    
-            ST_Distance(
-			    ST_Transform(start_location::geometry, 3857),
-			    ST_Transform(end_location::geometry, 3857)
-		    ) * cosd(ST_Y(start_location)
-        ) / 100) * 100 as distance_in_meters
-        FROM trips CROSS JOIN temp_a
+        SELECT {columns}{page_columns}
+        FROM trips
+        LEFT JOIN vehicle_type
+        ON trips.vehicle_type_id = vehicle_type.vehicle_type_id
+        LEFT JOIN trip_metrics
+        ON trips.trip_id = trip_metrics.trip_id
+        WHERE 
+        start_time >= %(start_time)s
+        AND end_time <= %(end_time)s
+        AND {filters}
+        {page_order}
+        """
+        return self.build_query(stmt, d_filter, membership)
+
+    # Origins or destinations aggregated in spatial_bins.SpatialBins, with per bin the count per
+    # form factor and per distance class. `column` is start_location or end_location.
+    def get_trip_events_heatmap(self, conn, d_filter, bins, column, membership):
+        stmt = """
+        SELECT bin_i, bin_j, bin_latitude, bin_longitude, form_factor,
+        width_bucket(
+            trip_metrics.distance_in_meters,
+            ARRAY[""" + ", ".join(str(bound) for bound in self.distance_classes) + """]
+        ) AS distance_class,
+        COUNT(*)
+        FROM trips
         LEFT JOIN vehicle_type
         ON trips.vehicle_type_id = vehicle_type.vehicle_type_id
+        LEFT JOIN trip_metrics
+        ON trips.trip_id = trip_metrics.trip_id
+        """ + bins.join(column) + """
         WHERE 
-        start_time >= %s
-        AND end_time <= %s
-        AND (false = %s or 
-            ST_Within(start_location, temp_a.filter_area))
-        AND (false = %s or trips.system_id IN %s)
-        AND (false = %s or 
-                (form_factor in %s or (true = %s and form_factor is null))
-            ) 
+        start_time >= %(start_time)s
+        AND end_time <= %(end_time)s
+        AND {filters}
+        GROUP BY bin_i, bin_j, bin_latitude, bin_longitude, form_factor, distance_class;
         """
-        cur.execute(stmt, (d_filter.get_zones(), d_filter.get_start_time(), 
-            d_filter.get_end_time(), d_filter.has_zone_filter(),
-            d_filter.has_operator_filter(), d_filter.get_operators(),
-            d_filter.has_form_factor_filter(), d_filter.get_form_factors(),
-            d_filter.include_unknown_form_factors()))
-        return self.serialize_trip_events(cur.fetchall())
-
-    def get_trip_destinations(self, conn, d_filter):
+        query = self.build_query(stmt, d_filter, membership)
+        query.param_types = query.param_types + spatial_bins.param_types
+        query.params["bin_size"] = bins.size
+        if d_filter.has_bbox():
+            sw_lng, sw_lat, ne_lng, ne_lat = d_filter.get_bbox()
+            query.where(column + " && ST_MakeEnvelope({sw_lng}, {sw_lat}, {ne_lng}, {ne_lat}, 4326)",
+                sw_lng=sw_lng, sw_lat=sw_lat, ne_lng=ne_lng, ne_lat=ne_lat)
         cur = conn.cursor()
-        stmt = """ 
-        WITH temp_a (filter_area) AS
-            (
-            SELECT st_union(area) 
-	            FROM zones WHERE zone_id IN %s
-        )
-
-        SELECT trips.system_id, st_y(end_location), st_x(end_location), 
-        end_time, form_factor,
-        ROUND(    
-            ST_Distance(
-			    ST_Transform(start_location::geometry, 3857),
-			    ST_Transform(end_location::geometry, 3857)
-		    ) * cosd(ST_Y(start_location)
-        ) / 100) * 100 as distance_in_meters
+        query.execute(cur)
+        # Trips without a distance (no trip_metrics row or no locations) are counted as "unknown".
+        labels = self.get_distance_class_labels()
+        rows = [row[:5] + (labels[row[5]] if row[5] is not None else None,) + row[6:] for row in cur.fetchall()]
+        return spatial_bins.serialize_bins(rows, ["form_factors", "distance_classes"])
+
+    def get_trip_origins_heatmap(self, conn, d_filter, bins):
+        return self.get_trip_events_heatmap(conn, d_filter, bins, "start_location", "starts_in")
+
+    def get_trip_destinations_heatmap(self, conn, d_filter, bins):
+        return self.get_trip_events_heatmap(conn, d_filter, bins, "end_location", "ends_in")
+
+    # Labels like "500-1000" per width_bucket result, 0 is below the first bound.
+    def get_distance_class_labels(self):
+        bounds = [0] + self.distance_classes
+        labels = ["%s-%s" % (bounds[index], bounds[index + 1]) for index in range(len(bounds) - 1)]
+        return labels + ["%s+" % bounds[-1]]
+
+    # Number of trips per (origin zone, destination zone) of the zones in the filter, with the count
+    # per operator and form factor, in one pass using the trip_zone membership table.
+    # A trip that starts or ends in overlapping zones is counted for every pair of those zones.
+    def get_od_matrix(self, conn, d_filter):
+        stmt = """
+        SELECT origin.zone_id, destination.zone_id, trips.system_id, form_factor, COUNT(*)
+        FROM trips
+        JOIN trip_zone AS origin
+        ON origin.trip_id = trips.trip_id
+        AND origin.starts_in
+        AND origin.zone_id = ANY(%(zone_ids)s)
+        JOIN trip_zone AS destination
+        ON destination.trip_id = trips.trip_id
+        AND destination.ends_in
+        AND destination.zone_id = ANY(%(zone_ids)s)
+        LEFT JOIN vehicle_type
+        ON trips.vehicle_type_id = vehicle_type.vehicle_type_id
+        WHERE 
+        start_time >= %(start_time)s
+        AND end_time <= %(end_time)s
+        AND {filters}
+        GROUP BY origin.zone_id, destination.zone_id, trips.system_id, form_factor;
+        """
+        query = QueryBuilder(stmt, self.filter_param_types, start_time=d_filter.get_start_time(),
+            end_time=d_filter.get_end_time(), zone_ids=d_filter.get_zone_ids())
+        add_operator_filter(query, d_filter, "trips.system_id")
+        add_form_factor_filter(query, d_filter)
+        cur = conn.cursor()
+        query.execute(cur)
+        return self.serialize_od_matrix(cur.fetchall())
+
+    # Rows are (origin zone_id, destination zone_id, system_id, form_factor, count).
+    def serialize_od_matrix(self, rows):
+        pairs = {}
+        for row in rows:
+            key = (row[0], row[1])
+            if key not in pairs:
+                data = {}
+                data["origin_zone_id"] = row[0]
+                data["destination_zone_id"] = row[1]
+                data["number_of_trips"] = 0
+                data["operators"] = {}
+                data["form_factors"] = {}
+                pairs[key] = data
+            pair = pairs[key]
+            form_factor = row[3] if row[3] is not None else "unknown"
+            pair["number_of_trips"] += row[4]
+            pair["operators"][row[2]] = pair["operators"].get(row[2], 0) + row[4]
+            pair["form_factors"][form_factor] = pair["form_factors"].get(form_factor, 0) + row[4]
+        return list(pairs.values())
+
+    # Distance and duration histograms of the trips in the period, per operator and, when the filter
+    # has zones, per zone the trips start or end in. Uses the stored values of trip_metrics.sql.
+    def get_histogram(self, conn, d_filter):
+        per_zone = d_filter.has_zone_filter()
+        stmt = """
+        SELECT """ + ("trip_zone.zone_id" if per_zone else "NULL::integer") + """, trips.system_id,
+            width_bucket(distance_in_meters, ARRAY[""" + ", ".join(str(bound) for bound in self.distance_bins) + """]) AS distance_bin,
+            width_bucket(duration_in_seconds, ARRAY[""" + ", ".join(str(bound) for bound in self.duration_bins) + """]) AS duration_bin,
+            COUNT(*)
         FROM trips
+        JOIN trip_metrics
+        ON trips.trip_id = trip_metrics.trip_id
+        """ + ("""JOIN trip_zone
+        ON trip_zone.trip_id = trips.trip_id
+        AND trip_zone.zone_id = ANY(%(zone_ids)s)""" if per_zone else "") + """
         LEFT JOIN vehicle_type
         ON trips.vehicle_type_id = vehicle_type.vehicle_type_id
         WHERE 
-        start_time >= %s
-        AND end_time <= %s
-        AND (false = %s or 
-            ST_Within(end_location, (SELECT filter_area from temp_a)))
-        AND (false = %s or trips.system_id IN %s)
-        AND (false = %s or 
-                (form_factor in %s or (true = %s and form_factor is null))
-            ) 
+        start_time >= %(start_time)s
+        AND end_time <= %(end_time)s
+        AND {filters}
+        GROUP BY 1, 2, distance_bin, duration_bin;
         """
-        cur.execute(stmt, (d_filter.get_zones(), d_filter.get_start_time(), 
-            d_filter.get_end_time(), d_filter.has_zone_filter(),
-            d_filter.has_operator_filter(), d_filter.get_operators(),
-            d_filter.has_form_factor_filter(), d_filter.get_form_factors(),
-            d_filter.include_unknown_form_factors()))
-        return self.serialize_trip_events(cur.fetchall())
+        query = QueryBuilder(stmt, self.filter_param_types, start_time=d_filter.get_start_time(),
+            end_time=d_filter.get_end_time(), zone_ids=d_filter.get_zone_ids())
+        add_operator_filter(query, d_filter, "trips.system_id")
+        add_form_factor_filter(query, d_filter)
+        cur = conn.cursor()
+        query.execute(cur)
+
+        result = {}
+        result["distance_bins"] = self.distance_bins
+        result["duration_bins"] = self.duration_bins
+        result["histograms"] = self.serialize_histograms(cur.fetchall())
+        return result
+
+    # Rows are (zone_id, system_id, distance_bin, duration_bin, count) with 1-based bins from
+    # width_bucket, 0 (a negative value) and NULL (no trip_metrics) aren't counted in that histogram.
+    def serialize_histograms(self, rows):
+        histograms = {}
+        for row in rows:
+            key = (row[0], row[1])
+            if key not in histograms:
+                data = {}
+                data["zone_id"] = row[0]
+                data["system_id"] = row[1]
+                data["number_of_trips"] = 0
+                data["distance"] = [0] * len(self.distance_bins)
+                data["duration"] = [0] * len(self.duration_bins)
+                histograms[key] = data
+            histogram = histograms[key]
+            histogram["number_of_trips"] += row[4]
+            if row[2]:
+                histogram["distance"][row[2] - 1] += row[4]
+            if row[3]:
+                histogram["duration"][row[3] - 1] += row[4]
+        return list(histograms.values())
 
     def query_stats(self, conn, zone_id, d_filter):
         cur = conn.cursor()
@@ -0,0 +1,65 @@
+import os
+from query_builder import QueryBuilder, add_operator_filter, add_form_factor_filter
+from zone_geometries import zone_set_filter
+
+# Most vehicles a viewport request returns, zoomed out maps should use clusters instead.
+max_rows = int(os.getenv("VEHICLES_BBOX_MAX_ROWS", 5000))
+
+class Vehicles():
+    filter_param_types = [
+        ("sw_lng", "float8"),
+        ("sw_lat", "float8"),
+        ("ne_lng", "float8"),
+        ("ne_lat", "float8"),
+        ("zone_ids", "integer[]"),
+        ("system_ids", "text[]"),
+        ("form_factors", "text[]"),
+        ("row_limit", "integer")
+    ]
+
+    # Last detection of the vehicles within the bbox of d_filter, with the operator, form factor and
+    # zone filters of the park event list. The && ST_MakeEnvelope condition uses the spatial index
+    # of last_detection_bike. Returns (vehicles, truncated), truncated is True when there were
+    # more than max_rows vehicles.
+    def get_vehicles_in_bbox(self, conn, d_filter):
+        stmt = """
+        SELECT last_detection_bike.system_id, bike_id,
+            ST_Y(location), ST_X(location),
+            last_time_imported, is_check_in, is_check_out, form_factor
+        FROM last_detection_bike
+        LEFT JOIN vehicle_type
+        ON last_detection_bike.vehicle_type_id = vehicle_type.vehicle_type_id
+        WHERE location && ST_MakeEnvelope(%(sw_lng)s, %(sw_lat)s, %(ne_lng)s, %(ne_lat)s, 4326)
+        AND {filters}
+        LIMIT %(row_limit)s;
+        """
+        sw_lng, sw_lat, ne_lng, ne_lat = d_filter.get_bbox()
+        query = QueryBuilder(stmt, self.filter_param_types, sw_lng=sw_lng, sw_lat=sw_lat,
+            ne_lng=ne_lng, ne_lat=ne_lat, row_limit=max_rows + 1)
+        add_operator_filter(query, d_filter, "last_detection_bike.system_id")
+        add_form_factor_filter(query, d_filter)
+        if d_filter.has_zone_filter():
+            query.where(zone_set_filter("location"), zone_ids=d_filter.get_zone_ids())
+        cur = conn.cursor()
+        query.execute(cur)
+        rows = cur.fetchall()
+        return self.serialize_vehicles(rows[:max_rows]), len(rows) > max_rows
+
+    def serialize_vehicles(self, vehicles):
+        result = []
+        for vehicle in vehicles:
+            result.append(self.serialize_vehicle(vehicle))
+        return result
+
+    def serialize_vehicle(self, vehicle):
+        data = {}
+        data["system_id"] = vehicle[0]
+        data["bike_id"] = vehicle[1]
+        data["location"] = {}
+        data["location"]["latitude"] = vehicle[2]
+        data["location"]["longitude"] = vehicle[3]
+        data["last_time_imported"] = vehicle[4]
+        data["is_check_in"] = vehicle[5]
+        data["is_check_out"] = vehicle[6]
+        data["form_factor"] = vehicle[7]
+        return data
@@ -0,0 +1,59 @@
+import os
+import threading
+import time
+
+# Zone filters on the parts of the zones in the zone_part table (zone_part.sql).
+#
+# Testing rows against the areas of many zones (e.g. all neighbourhoods of a city) dominated the
+# query time. The areas are split in small parts with ST_Subdivide when a zone is stored, so the
+# spatial index is selective. The parts are maintained by a trigger on zones, requests only read them.
+
+# Condition for query_builder.QueryBuilder.where() that is true when the geometry in `column`
+# lies in one of the zones {zone_ids}.
+# ST_Intersects is used because a point on the border between two parts is within neither part.
+def zone_set_filter(column):
+    return """EXISTS (
+                SELECT 1
+                FROM zone_part
+                WHERE zone_part.zone_id = ANY({zone_ids})
+                AND ST_Intersects(zone_part.area, """ + column + """)
+            )"""
+
+# Returns the ids of zone_ids that don't exist.
+def find_unknown_zone_ids(conn, zone_ids):
+    cur = conn.cursor()
+    cur.execute("SELECT zone_id FROM zones WHERE zone_id = ANY(%s)", (list(zone_ids),))
+    known = set(row[0] for row in cur.fetchall())
+    conn.commit()
+    return [zone_id for zone_id in zone_ids if zone_id not in known]
+
+# Zone ids that are known to exist, so zone-filtered requests only query zones for ids they
+# haven't seen in the last `ttl` seconds. Only existing ids are cached, a zone that was just created
+# is found right away. A deleted zone is forgotten by the process that deleted it, other processes
+# treat it as known until the ttl passes (the filter then matches nothing).
+class KnownZoneIds():
+    def __init__(self, ttl=300):
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._expires_at = {}
+
+    # get_conn returns a database connection, it is only called for ids that aren't cached.
+    def find_unknown(self, get_conn, zone_ids):
+        now = time.monotonic()
+        with self._lock:
+            uncached = [zone_id for zone_id in zone_ids if self._expires_at.get(zone_id, 0) <= now]
+        if not uncached:
+            return []
+        unknown = find_unknown_zone_ids(get_conn(), uncached)
+        with self._lock:
+            for zone_id in uncached:
+                if zone_id not in unknown:
+                    self._expires_at[zone_id] = now + self.ttl
+        return unknown
+
+    def forget(self, zone_id):
+        with self._lock:
+            self._expires_at.pop(zone_id, None)
+
+
+known_zone_ids = KnownZoneIds(ttl=int(os.getenv("KNOWN_ZONE_IDS_TTL", 300)))
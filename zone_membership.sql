@@ -0,0 +1,101 @@
+-- Zones that contain a park event or the start/end of a trip, so stats per zone can join on ids
+-- instead of testing every row against the zone geometries.
+-- New park events and trips are added by the triggers below. refresh_zone_membership(zone_id)
+-- (re)computes all rows of one zone, a trigger on zones calls it when a zone is inserted (by the
+-- API or the importer) or its area changes. Deleted zones cascade.
+-- Existing zones are filled at the end of this file, this scans park_events and trips once per zone.
+
+CREATE TABLE IF NOT EXISTS park_event_zone (
+    park_event_id bigint NOT NULL,
+    zone_id integer NOT NULL REFERENCES zones (zone_id) ON DELETE CASCADE,
+    PRIMARY KEY (zone_id, park_event_id)
+);
+CREATE INDEX IF NOT EXISTS park_event_zone_park_event_id_idx ON park_event_zone (park_event_id);
+
+CREATE TABLE IF NOT EXISTS trip_zone (
+    trip_id bigint NOT NULL,
+    zone_id integer NOT NULL REFERENCES zones (zone_id) ON DELETE CASCADE,
+    starts_in boolean NOT NULL,
+    ends_in boolean NOT NULL,
+    PRIMARY KEY (zone_id, trip_id)
+);
+CREATE INDEX IF NOT EXISTS trip_zone_trip_id_idx ON trip_zone (trip_id);
+
+CREATE OR REPLACE FUNCTION park_event_zone_update() RETURNS trigger AS $$
+BEGIN
+    IF TG_OP = 'UPDATE' THEN
+        DELETE FROM park_event_zone WHERE park_event_id = NEW.park_event_id;
+    END IF;
+    INSERT INTO park_event_zone (park_event_id, zone_id)
+    SELECT NEW.park_event_id, zone_id
+    FROM zones
+    WHERE ST_Within(NEW.location, area)
+    ON CONFLICT DO NOTHING;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS park_event_zone_trigger ON park_events;
+CREATE TRIGGER park_event_zone_trigger
+    AFTER INSERT OR UPDATE OF location ON park_events
+    FOR EACH ROW EXECUTE FUNCTION park_event_zone_update();
+
+CREATE OR REPLACE FUNCTION trip_zone_update() RETURNS trigger AS $$
+BEGIN
+    IF TG_OP = 'UPDATE' THEN
+        DELETE FROM trip_zone WHERE trip_id = NEW.trip_id;
+    END IF;
+    INSERT INTO trip_zone (trip_id, zone_id, starts_in, ends_in)
+    SELECT NEW.trip_id, zone_id,
+        COALESCE(ST_Within(NEW.start_location, area), false),
+        COALESCE(ST_Within(NEW.end_location, area), false)
+    FROM zones
+    WHERE ST_Within(NEW.start_location, area) OR ST_Within(NEW.end_location, area)
+    ON CONFLICT DO NOTHING;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS trip_zone_trigger ON trips;
+CREATE TRIGGER trip_zone_trigger
+    AFTER INSERT OR UPDATE OF start_location, end_location ON trips
+    FOR EACH ROW EXECUTE FUNCTION trip_zone_update();
+
+CREATE OR REPLACE FUNCTION refresh_zone_membership(refresh_zone_id integer) RETURNS void AS $$
+    DELETE FROM park_event_zone WHERE zone_id = refresh_zone_id;
+    INSERT INTO park_event_zone (park_event_id, zone_id)
+    SELECT park_event_id, zone_id
+    FROM park_events
+    JOIN zones
+    ON ST_Within(location, area)
+    WHERE zones.zone_id = refresh_zone_id;
+
+    DELETE FROM trip_zone WHERE zone_id = refresh_zone_id;
+    INSERT INTO trip_zone (trip_id, zone_id, starts_in, ends_in)
+    SELECT trip_id, zone_id,
+        COALESCE(ST_Within(start_location, area), false),
+        COALESCE(ST_Within(end_location, area), false)
+    FROM trips
+    JOIN zones
+    ON ST_Within(start_location, area) OR ST_Within(end_location, area)
+    WHERE zones.zone_id = refresh_zone_id;
+$$ LANGUAGE sql;
+
+CREATE OR REPLACE FUNCTION zone_membership_update() RETURNS trigger AS $$
+BEGIN
+    PERFORM refresh_zone_membership(NEW.zone_id);
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS zone_membership_trigger ON zones;
+CREATE TRIGGER zone_membership_trigger
+    AFTER INSERT OR UPDATE OF area ON zones
+    FOR EACH ROW EXECUTE FUNCTION zone_membership_update();
+
+-- Initial fill for the zones stored before the triggers existed. Zones that already have rows
+-- are skipped, so running the migration again only fills the zones that are still empty.
+SELECT refresh_zone_membership(zone_id)
+FROM zones
+WHERE NOT EXISTS (SELECT 1 FROM park_event_zone WHERE park_event_zone.zone_id = zones.zone_id)
+AND NOT EXISTS (SELECT 1 FROM trip_zone WHERE trip_zone.zone_id = zones.zone_id);
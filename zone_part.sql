@@ -0,0 +1,38 @@
+-- Areas of the zones split in small parts with ST_Subdivide, see zone_geometries.py.
+-- The parts are kept up to date by the trigger below, in the same transaction as the change
+-- of the zone, and are removed with the zone. Existing zones are filled at the end of this file.
+
+-- Replaced by zone_part, it stored the union per combination of zones at request time.
+DROP TABLE IF EXISTS zone_set_geometry;
+
+CREATE TABLE IF NOT EXISTS zone_part (
+    zone_id integer NOT NULL REFERENCES zones (zone_id) ON DELETE CASCADE,
+    area geometry(Geometry, 4326) NOT NULL
+);
+
+CREATE INDEX IF NOT EXISTS zone_part_zone_id_idx ON zone_part (zone_id);
+CREATE INDEX IF NOT EXISTS zone_part_area_idx ON zone_part USING GIST (area);
+
+CREATE OR REPLACE FUNCTION zone_part_update() RETURNS trigger AS $$
+BEGIN
+    IF TG_OP = 'UPDATE' THEN
+        DELETE FROM zone_part WHERE zone_id = NEW.zone_id;
+    END IF;
+    INSERT INTO zone_part (zone_id, area)
+    SELECT NEW.zone_id, ST_Subdivide(NEW.area, 256)
+    WHERE NEW.area IS NOT NULL;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS zone_part_trigger ON zones;
+CREATE TRIGGER zone_part_trigger
+    AFTER INSERT OR UPDATE OF area ON zones
+    FOR EACH ROW EXECUTE FUNCTION zone_part_update();
+
+-- Initial fill for the zones stored before the trigger existed, running it again is a no-op.
+INSERT INTO zone_part (zone_id, area)
+SELECT zone_id, ST_Subdivide(area, 256)
+FROM zones
+WHERE area IS NOT NULL
+AND NOT EXISTS (SELECT 1 FROM zone_part WHERE zone_part.zone_id = zones.zone_id);
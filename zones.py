@@ -63,7 +63,7 @@ class Zones():
     def create_zone(self, conn, data):
         cur = conn.cursor()
 
-        if not self.check_if_zone_is_valid(data):
+        if not self.check_if_zone_is_valid(conn, data):
             return None, "Zone is outside municipality borders."
 
         stmt = """
@@ -73,9 +73,15 @@ class Zones():
         (ST_SetSRID(ST_GeomFromGeoJSON(%s), 4326), %s, %s, 'custom')
         RETURNING zone_id
         """
-        cur.execute(stmt, (json.dumps(data.get("geojson")), data.get("name"), data.get("municipality")))
-        data["zone_id"] = cur.fetchone()[0]
-        conn.commit()
+        # The trigger on zones fills park_event_zone and trip_zone (zone_membership.sql) in the same
+        # transaction, a failed membership fill leaves no zone behind.
+        try:
+            cur.execute(stmt, (json.dumps(data.get("geojson")), data.get("name"), data.get("municipality")))
+            data["zone_id"] = cur.fetchone()[0]
+            conn.commit()
+        except:
+            conn.rollback()
+            raise
         return data, None
 
     def delete_zone(self, conn, zone_id):
@@ -92,7 +98,6 @@ class Zones():
         conn.commit()
         succesful = (len(cur.fetchall()) > 0)
         cur.close()
-
         return succesful
 
 